@@ -0,0 +1,154 @@
+import asyncio
+import json
+import random
+import sys
+import time
+
+from lifx_emulator import EmulatedLifxDevice, LifxEmulatorFleet
+from message_decoder import MessageDecoder
+from message_encoder import MessageType, PacketTemplate
+from message_maker import MessageMaker
+from message_router import MessageRouter
+from notes_to_hue_converter import MidiNote, NotesToHueConverter, PitchClassHueTable
+
+
+class Benchmarks:
+    DURATION: float = 1  # seconds per benchmark
+    CHORD_SIZES: list[int] = [1, 2, 4, 8, 16, 32, 64, 88]
+    SEED: int = 1
+
+    @staticmethod
+    def ops_per_second(name: str, operation, duration: float = None) -> dict:
+        duration = Benchmarks.DURATION if duration is None else duration
+        operations = 0
+        start_time = time.perf_counter()
+        elapsed = 0
+        while elapsed < duration:
+            for _ in range(1000):
+                operation()
+            operations += 1000
+            elapsed = time.perf_counter() - start_time
+        return {'benchmark': name, 'ops_per_sec': operations / elapsed}
+
+    @staticmethod
+    async def async_ops_per_second(name: str, operation, duration: float = None, batch: int = 100) -> dict:
+        duration = Benchmarks.DURATION if duration is None else duration
+        operations = 0
+        start_time = time.perf_counter()
+        elapsed = 0
+        while elapsed < duration:
+            for _ in range(batch):
+                await operation()
+            operations += batch
+            elapsed = time.perf_counter() - start_time
+        return {'benchmark': name, 'ops_per_sec': operations / elapsed}
+
+    @staticmethod
+    def bench_set_color_generate_packed_message() -> dict:
+        return Benchmarks.ops_per_second(
+            'encoder.set_color.generate_packed_message',
+            lambda: MessageMaker.SetColor(hue=120, saturation=1, brightness=1).generate_packed_message()
+        )
+
+    @staticmethod
+    def bench_set_color_packet() -> dict:
+        packet = MessageMaker.SetColorPacket()
+        return Benchmarks.ops_per_second(
+            'encoder.set_color.packet',
+            lambda: packet.pack(hue=120, saturation=1, brightness=1)
+        )
+
+    # one sample packet per type, packed the way a bulb would answer
+    @staticmethod
+    def sample_packets() -> dict[MessageType, bytes]:
+        device = EmulatedLifxDevice(label='Benchmark', serial=bytes.fromhex('d073d5000001'))
+        samples = {
+            MessageType.STATE_SERVICE: (1, 56700),
+            MessageType.STATE_POWER: (65535,),
+            MessageType.STATE_LABEL: (b'Benchmark',),
+            MessageType.ACKNOWLEDGEMENT: (),
+            MessageType.LIGHT_STATE: device.light_state[1:]
+        }
+        packets = {}
+        for msg_type, payload in samples.items():
+            template = PacketTemplate.get(msg_type, EmulatedLifxDevice.STATE_PAYLOAD_FORMATS[msg_type], tagged=False)
+            packets[msg_type] = bytes(template.pack(device.target, *payload))
+        packets[MessageType.SET_COLOR] = MessageMaker.SetColor(hue=120).generate_packed_message()
+        return packets
+
+    @staticmethod
+    def bench_decode() -> list[dict]:
+        results = []
+        for msg_type, packet in Benchmarks.sample_packets().items():
+            results.append(Benchmarks.ops_per_second(
+                f'decoder.{msg_type.name.lower()}',
+                lambda: MessageDecoder.decode(packet).payload
+            ))
+        return results
+
+    @staticmethod
+    async def bench_converter() -> list[dict]:
+        rng = random.Random(Benchmarks.SEED)
+        hue_table = PitchClassHueTable()
+        results = []
+        for chord_size in Benchmarks.CHORD_SIZES:
+            pitches = rng.sample(range(21, 109), chord_size)
+            notes = [MidiNote(pitch=p, velocity=rng.randint(1, 127)) for p in pitches]
+            converter = NotesToHueConverter(notes)
+            table_converter = NotesToHueConverter(notes, hue_table=hue_table)
+            note = MidiNote(pitch=pitches[0], velocity=100)
+            for name, operation in [
+                ('add_note', lambda: converter.add_note(note)),
+                ('convert', converter.convert),
+                ('convert_table', table_converter.convert)
+            ]:
+                result = await Benchmarks.async_ops_per_second(f'converter.{name}', operation)
+                result['chord_size'] = chord_size
+                results.append(result)
+        return results
+
+    @staticmethod
+    async def bench_router(in_flight: list[int] = None) -> list[dict]:
+        in_flight = [1, 16, 64] if in_flight is None else in_flight
+        fleet = LifxEmulatorFleet(1)
+        router = MessageRouter()
+        device = LifxDeviceStandIn((await fleet.start())[0])
+        results = []
+        try:
+            for pipelined in in_flight:
+                async def round_trips():
+                    await asyncio.gather(*[
+                        router.send_and_await_response(MessageMaker.SetColor(hue=120), device)
+                        for _ in range(pipelined)
+                    ])
+
+                result = await Benchmarks.async_ops_per_second('router.round_trip', round_trips, batch=10)
+                result['ops_per_sec'] *= pipelined
+                result['in_flight'] = pipelined
+                results.append(result)
+        finally:
+            router.close_transport()
+            fleet.close()
+        return results
+
+
+class LifxDeviceStandIn:
+    def __init__(self, address: tuple):
+        self.address: tuple = address
+
+
+async def run_benchmarks() -> list[dict]:
+    results = [
+        Benchmarks.bench_set_color_generate_packed_message(),
+        Benchmarks.bench_set_color_packet()
+    ]
+    results += Benchmarks.bench_decode()
+    results += await Benchmarks.bench_converter()
+    results += await Benchmarks.bench_router()
+    return results
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        Benchmarks.DURATION = float(sys.argv[1])
+    print(json.dumps(asyncio.run(run_benchmarks()), indent=2))
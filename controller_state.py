@@ -0,0 +1,70 @@
+import time
+
+
+# Latest value of every expressive controller of one converter: note velocity, aftertouch, pitch bend and the
+# modulation and expression CCs. Controller messages overwrite their value as they arrive and each outgoing
+# frame reads them all once, so a burst of hundreds of aftertouch or CC messages reaches the bulbs as a single
+# color change carrying only the last value of every controller.
+class ControllerState:
+    CC_CONTROLLERS: dict = {
+        1: 'modulation',
+        11: 'expression'
+    }
+    DEFAULTS: dict = {'velocity': 127, 'aftertouch': 0, 'pitch_bend': 8192, 'modulation': 0, 'expression': 127}
+    MAX_VALUE: int = 127
+    PITCH_BEND_CENTER: int = 8192
+    MIN_BRIGHTNESS: float = 0.1  # brightness of the softest note, so quiet playing stays visible
+    KELVIN_BEND: int = 2500  # kelvin shift at full pitch bend, up or down
+    MIN_KELVIN: int = 1500
+    MAX_KELVIN: int = 9000
+
+    def __init__(self):
+        self.values: dict[str, int] = dict(ControllerState.DEFAULTS)
+        self.version: int = 0
+        self.read_version: int = 0  # version of the values the last frame was built from
+        self.timestamp: float | None = None  # monotonic time of the event behind the latest value, if known
+        self.received: int = 0
+        self.coalesced: int = 0  # values overwritten before any frame read them
+
+    @property
+    def is_pending(self) -> bool:
+        return self.version != self.read_version
+
+    def set(self, controller: str, value: int, timestamp: float = None) -> None:
+        self.received += 1
+        if self.values[controller] == value:
+            return
+        if self.is_pending:
+            self.coalesced += 1
+        self.values[controller] = value
+        self.timestamp = time.monotonic() if timestamp is None else timestamp
+        self.version += 1
+
+    # returns False for CCs without a mapping
+    def set_cc(self, cc: int, value: int, timestamp: float = None) -> bool:
+        controller = ControllerState.CC_CONTROLLERS.get(cc)
+        if controller is None:
+            return False
+        self.set(controller, value, timestamp)
+        return True
+
+    def set_pitch_bend(self, lsb: int, msb: int, timestamp: float = None) -> None:
+        self.set('pitch_bend', lsb | msb << 7, timestamp)
+
+    # Velocity sets the brightness of a note and aftertouch pushes it towards full, both scaled by expression.
+    # The modulation wheel washes the color out towards white and pitch bend warms or cools the white point.
+    def modulate(self, color: dict) -> dict:
+        values = self.values
+        level = values['velocity'] / ControllerState.MAX_VALUE
+        level += (1 - level) * values['aftertouch'] / ControllerState.MAX_VALUE
+        level *= values['expression'] / ControllerState.MAX_VALUE
+        brightness = ControllerState.MIN_BRIGHTNESS + (1 - ControllerState.MIN_BRIGHTNESS) * level
+        bend = (values['pitch_bend'] - ControllerState.PITCH_BEND_CENTER) / ControllerState.PITCH_BEND_CENTER
+        kelvin = color.get('kelvin', 4000) + round(bend * ControllerState.KELVIN_BEND)
+        self.read_version = self.version
+        return {
+            **color,
+            'brightness': color.get('brightness', 1) * brightness,
+            'saturation': color.get('saturation', 1) * (1 - values['modulation'] / ControllerState.MAX_VALUE),
+            'kelvin': max(ControllerState.MIN_KELVIN, min(ControllerState.MAX_KELVIN, kelvin))
+        }
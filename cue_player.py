@@ -0,0 +1,164 @@
+import asyncio
+import sys
+import time
+
+import numpy as np
+
+from globals import Globals
+from lifx_device import LifxDevice
+from lifx_device_set import LifxDeviceSet
+from message_encoder import MessageEncoder, MessageType, PacketTemplate
+from message_maker import MessageMaker
+from offline_renderer import CueFile
+
+
+# Plays a rendered cue file. Every SetColor packet of the show, for every device, is encoded up front into one
+# contiguous buffer (memory-mapped when a buffer path is given), so playback only hands slices of it to the
+# router on a schedule anchored to a single monotonic origin, which keeps long shows from drifting.
+class CuePlayer:
+    PAYLOAD_FORMAT: str = MessageMaker.SetColor.PAYLOAD_FORMAT[1:]
+    # a SetColor packet, with the fields that change between cues at their byte offsets
+    PACKET = np.dtype({
+        'names': ['sequence', 'hue', 'saturation', 'brightness', 'kelvin', 'duration'],
+        'formats': ['u1', '<u2', '<u2', '<u2', '<u2', '<u4'],
+        'offsets': [23, 37, 39, 41, 43, 45],
+        'itemsize': PacketTemplate.get(MessageType.SET_COLOR, PAYLOAD_FORMAT).size
+    })
+    MIN_LENGTH: float = 1 / LifxDevice.MAX_MESSAGES_PER_SECOND  # a looping show of instant cues still waits a frame
+
+    def __init__(self, devices: list[LifxDevice], cues: np.ndarray, buffer_path: str = None, loop: bool = False):
+        self.devices: list[LifxDevice] = devices
+        self.addresses: list[tuple] = [device.address for device in devices]
+        self.times: np.ndarray = np.asarray(cues['time'], dtype=np.float64)
+        self.loop: bool = loop
+        # seconds of one pass through the show, the last cue is held for its duration before the show loops
+        self.length: float = 0
+        if len(self.times):
+            self.length = max(float(self.times[-1] + cues['duration'][-1] / 1000), CuePlayer.MIN_LENGTH)
+        self.packets: np.ndarray = self.encode(cues, buffer_path)
+        self.buffer: memoryview = memoryview(self.packets.view(np.uint8).reshape(-1))
+
+        self.is_playing: bool = False
+        self.position: int = 0  # index of the next cue
+        self.origin: float = 0  # monotonic time of the show's zero
+        self.rescheduled = asyncio.Event()
+        self.sent_cues: int = 0
+        self.skipped_cues: int = 0  # overdue cues replaced by a later overdue one
+
+    @staticmethod
+    def from_file(
+            devices: list[LifxDevice],
+            cue_path: str,
+            buffer_path: str = None,
+            loop: bool = False
+    ) -> 'CuePlayer':
+        return CuePlayer(devices, CueFile.read(cue_path), buffer_path, loop)
+
+    def encode(self, cues: np.ndarray, buffer_path: str = None) -> np.ndarray:
+        shape = (len(cues), len(self.devices))
+        if buffer_path is None or len(cues) == 0:
+            packets = np.zeros(shape, dtype=CuePlayer.PACKET)
+        else:
+            packets = np.memmap(buffer_path, dtype=CuePlayer.PACKET, mode='w+', shape=shape)
+
+        raw = packets.view(np.uint8).reshape(*shape, CuePlayer.PACKET.itemsize)
+        for column, device in enumerate(self.devices):
+            tagged = device.target is None
+            target = 0 if tagged else int.from_bytes(bytes.fromhex(device.target), byteorder='little')
+            template = PacketTemplate.get(MessageType.SET_COLOR, CuePlayer.PAYLOAD_FORMAT, tagged=tagged)
+            raw[:, column] = np.frombuffer(bytes(template.pack(target, 0, 0, 0, 0, 0, sequence=0)), dtype=np.uint8)
+
+        # same colors as LifxDeviceSet.color_for_hue, packed like MessageMaker.hsbk
+        hues = np.asarray(cues['hue'], dtype=np.float64)
+        no_notes = hues == -1
+        hsbk = {
+            'sequence': np.arange(len(cues)) % 256,
+            'hue': np.where(no_notes, 0, hues % 360 / 360 * MessageEncoder.MAX_UINT16).astype(np.uint16),
+            'saturation': np.where(no_notes, 0, MessageEncoder.MAX_UINT16),
+            'brightness': MessageEncoder.MAX_UINT16,
+            'kelvin': np.where(no_notes, 5000, 4000),
+            'duration': cues['duration']
+        }
+        for field, values in hsbk.items():
+            packets[field] = np.asarray(values)[:, None] if np.ndim(values) else values
+        if isinstance(packets, np.memmap):
+            packets.flush()
+        return packets
+
+    def packet(self, cue: int, column: int) -> memoryview:
+        start = (cue * len(self.devices) + column) * CuePlayer.PACKET.itemsize
+        return self.buffer[start:start + CuePlayer.PACKET.itemsize]
+
+    def send_cue(self, cue: int) -> None:
+        for column, address in enumerate(self.addresses):
+            Globals.router.send(self.packet(cue, column), address)
+        self.sent_cues += 1
+
+    def seek(self, seconds: float) -> None:
+        self.position = int(np.searchsorted(self.times, seconds, side='left'))
+        self.origin = time.monotonic() - seconds
+        self.rescheduled.set()
+
+    # Each cue is due at origin + its time. When several cues are overdue, only the latest one is sent.
+    async def play(self, start: float = 0) -> None:
+        if len(self.times) == 0:
+            return
+        await Globals.router.open_transport()
+        self.is_playing = True
+        self.seek(start)
+        while self.is_playing:
+            if self.position >= len(self.times):
+                if not self.loop:
+                    break
+                self.position = 0
+                self.origin += self.length
+            self.rescheduled.clear()
+            delay = self.origin + self.times[self.position] - time.monotonic()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.rescheduled.wait(), delay)
+                    continue  # seeked or stopped while waiting
+                except asyncio.TimeoutError:
+                    pass
+            now = time.monotonic() - self.origin
+            due = int(np.searchsorted(self.times, now, side='right')) - 1
+            if due > self.position:
+                self.skipped_cues += due - self.position
+                self.position = due
+            self.send_cue(self.position)
+            self.position += 1
+        self.is_playing = False
+
+    def stop(self) -> None:
+        self.is_playing = False
+        self.rescheduled.set()
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'cues': len(self.times),
+            'devices': len(self.devices),
+            'buffer_bytes': self.packets.nbytes,
+            'sent_cues': self.sent_cues,
+            'skipped_cues': self.skipped_cues
+        }
+
+
+async def main(cue_path: str, loop: bool = False) -> None:
+    devices = LifxDeviceSet.load_cached_devices()
+    if len(devices) == 0:
+        devices = await LifxDeviceSet().discover_devices(0.5)
+    player = CuePlayer.from_file(devices, cue_path, buffer_path=cue_path + '.packets', loop=loop)
+    print(f'Playing {len(player.times)} cues on {len(devices)} devices...')
+    try:
+        await player.play()
+    finally:
+        Globals.router.close_transport()
+        print(player.stats)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print('Usage: python cue_player.py <file.cue> [--loop]')
+        sys.exit(1)
+    asyncio.run(main(sys.argv[1], '--loop' in sys.argv[2:]))
@@ -0,0 +1,190 @@
+import mmap
+import socket
+import struct
+import time
+from enum import Enum
+
+
+class JournalRecordType(Enum):
+    MIDI_IN = 1
+    HUE = 2
+    PACKET_SENT = 3
+    PACKET_RECEIVED = 4
+    SESSION_START = 5
+    ROUTE = 6
+
+
+# Append-only binary journal of fixed-size records: MIDI events as received, hues as converted, and packets as
+# sent and received. Records are packed into a preallocated batch and written BATCH_RECORDS at a time, or after
+# FLUSH_INTERVAL seconds, so recording costs one pack_into. Disabled until a file is opened. Every open appends
+# a SESSION_START record, since monotonic times and converter state do not carry over from one run to the next.
+class EventJournal:
+    MAGIC: bytes = b'CNJL'
+    VERSION: int = 1
+    HEADER = struct.Struct('<4sHH8x')  # magic, version, record size
+    # monotonic time, record type, port, IPv4 address, data length (before truncation), data
+    RECORD = struct.Struct('<dBxH4sH2x108s')
+    DATA_SIZE: int = 108
+    ROUTE_ADDRESS = struct.Struct('<4sH')
+    ROUTE_ADDRESSES: int = (DATA_SIZE - 1) // ROUTE_ADDRESS.size  # devices per ROUTE record
+    ANY_CHANNEL: int = 255
+    BATCH_RECORDS: int = 256
+    FLUSH_INTERVAL: float = 1  # seconds
+
+    def __init__(self, path: str = None):
+        self.file = None
+        self.batch = bytearray(EventJournal.RECORD.size * EventJournal.BATCH_RECORDS)
+        self.batched: int = 0
+        self.last_flush: float = 0
+        self.records: int = 0
+        if path is not None:
+            self.open(path)
+
+    @property
+    def enabled(self) -> bool:
+        return self.file is not None
+
+    def open(self, path: str) -> None:
+        self.file = open(path, 'ab', buffering=0)
+        if self.file.tell() == 0:
+            header = EventJournal.HEADER.pack(EventJournal.MAGIC, EventJournal.VERSION, EventJournal.RECORD.size)
+            self.file.write(header)
+        self.last_flush = time.monotonic()
+        self.record(JournalRecordType.SESSION_START, b'')
+
+    def close(self) -> None:
+        if self.file is None:
+            return
+        self.flush()
+        self.file.close()
+        self.file = None
+
+    def flush(self) -> None:
+        if self.batched > 0:
+            self.file.write(memoryview(self.batch)[:self.batched * EventJournal.RECORD.size])
+            self.batched = 0
+        self.last_flush = time.monotonic()
+
+    @staticmethod
+    def pack_address(address: tuple | None) -> tuple[bytes, int]:
+        if address is None:
+            return bytes(4), 0
+        try:
+            return socket.inet_aton(address[0]), address[1]
+        except OSError:
+            return b'\xff\xff\xff\xff', address[1]  # '<broadcast>'
+
+    def record(
+            self,
+            record_type: JournalRecordType,
+            data: bytes,
+            timestamp: float = None,
+            address: tuple = None
+    ) -> None:
+        if self.file is None:
+            return
+        now = time.monotonic()
+        ip, port = EventJournal.pack_address(address)
+        EventJournal.RECORD.pack_into(
+            self.batch, self.batched * EventJournal.RECORD.size,
+            now if timestamp is None else timestamp, record_type.value, port, ip, len(data), bytes(data)
+        )
+        self.batched += 1
+        self.records += 1
+        if self.batched == EventJournal.BATCH_RECORDS or now - self.last_flush > EventJournal.FLUSH_INTERVAL:
+            self.flush()
+
+    # the MIDI input port is kept in the port field
+    def record_midi(self, message: list[int], timestamp: float = None, midi_input_index: int = 0) -> None:
+        self.record(
+            JournalRecordType.MIDI_IN, bytes(message[:EventJournal.DATA_SIZE]), timestamp, ('0.0.0.0', midi_input_index)
+        )
+
+    # Which devices a MIDI input port and channel drive, channel None for every channel not routed elsewhere.
+    # Kept in the port field and the first data byte, followed by the device addresses, over as many records
+    # as they need.
+    def record_route(self, midi_input_index: int, channel: int | None, addresses: list[tuple]) -> None:
+        channel_byte = bytes([EventJournal.ANY_CHANNEL if channel is None else channel])
+        for start in range(0, max(len(addresses), 1), EventJournal.ROUTE_ADDRESSES):
+            data = channel_byte + b''.join([
+                EventJournal.ROUTE_ADDRESS.pack(*EventJournal.pack_address(address))
+                for address in addresses[start:start + EventJournal.ROUTE_ADDRESSES]
+            ])
+            self.record(JournalRecordType.ROUTE, data, address=('0.0.0.0', midi_input_index))
+
+    def record_hue(self, hue: float, timestamp: float = None) -> None:
+        self.record(JournalRecordType.HUE, struct.pack('<d', hue), timestamp)
+
+    def record_packet(self, record_type: JournalRecordType, packet: bytes, address: tuple) -> None:
+        self.record(record_type, packet, address=address)
+
+
+class JournalRecord:
+    __slots__ = ('time', 'record_type', 'address', 'length', 'data')
+
+    def __init__(self, time: float, record_type: int, port: int, ip: bytes, length: int, data: bytes):
+        self.time: float = time
+        self.record_type: JournalRecordType = JournalRecordType(record_type)
+        self.address: tuple = (socket.inet_ntoa(ip), port)
+        self.length: int = length  # original length, data keeps at most the first DATA_SIZE bytes
+        self.data: bytes = data[:length]
+
+    @property
+    def message(self) -> list[int]:
+        return list(self.data)
+
+    @property
+    def hue(self) -> float:
+        return struct.unpack('<d', self.data)[0]
+
+    # MIDI input port, channel and device addresses of a ROUTE record
+    @property
+    def route(self) -> tuple[int, int | None, list[tuple]]:
+        channel = None if self.data[0] == EventJournal.ANY_CHANNEL else self.data[0]
+        addresses = [
+            (socket.inet_ntoa(ip), port) for ip, port in EventJournal.ROUTE_ADDRESS.iter_unpack(self.data[1:])
+        ]
+        return self.address[1], channel, addresses
+
+
+# Memory-mapped view of a journal file. A record cut short by a crash at the end of the file is ignored.
+class JournalReader:
+    def __init__(self, path: str):
+        with open(path, 'rb') as journal_file:
+            self.mmap = mmap.mmap(journal_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size = EventJournal.HEADER.unpack_from(self.mmap)
+        if magic != EventJournal.MAGIC or version != EventJournal.VERSION or record_size != EventJournal.RECORD.size:
+            raise ValueError(f'{path} is not a version {EventJournal.VERSION} event journal')
+        self.count: int = (len(self.mmap) - EventJournal.HEADER.size) // EventJournal.RECORD.size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index: int) -> JournalRecord:
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        offset = EventJournal.HEADER.size + index * EventJournal.RECORD.size
+        return JournalRecord(*EventJournal.RECORD.unpack_from(self.mmap, offset))
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self[index]
+
+    def records(self, record_type: JournalRecordType) -> list[JournalRecord]:
+        return [record for record in self if record.record_type == record_type]
+
+    # records split at every SESSION_START, which is kept as the first record of its session
+    def sessions(self) -> list[list[JournalRecord]]:
+        sessions = [[]]
+        for record in self:
+            if record.record_type == JournalRecordType.SESSION_START and sessions[-1]:
+                sessions.append([])
+            sessions[-1].append(record)
+        return [session for session in sessions if session]
+
+    @staticmethod
+    def of_type(records: list[JournalRecord], record_type: JournalRecordType) -> list[JournalRecord]:
+        return [record for record in records if record.record_type == record_type]
+
+    def close(self) -> None:
+        self.mmap.close()
@@ -0,0 +1,111 @@
+import asyncio
+import time
+
+from globals import Globals
+from lifx_device_set import LifxDeviceSet
+
+
+# Renders frames at a fixed tick rate from the latest converter state, instead of sending on every hue change.
+# A device is skipped when the new color is within the perceptual thresholds of the last color it was given,
+# so dense playing costs at most one color per device per tick and a change waits at most one tick.
+# Controller changes (velocity, aftertouch, pitch bend, CCs) are merged into the next frame the same way.
+class FrameScheduler:
+    TICK_RATE: float = 30  # frames per second
+    HUE_THRESHOLD: float = 2  # degrees, scaled by saturation since hue is invisible on white
+    SATURATION_THRESHOLD: float = 0.01
+    BRIGHTNESS_THRESHOLD: float = 0.01
+    KELVIN_THRESHOLD: int = 50
+    DEFAULT_COLOR: dict = {'hue': 0, 'saturation': 1, 'brightness': 1, 'kelvin': 4000}
+
+    def __init__(
+            self,
+            device_set: LifxDeviceSet,
+            tick_rate: float = TICK_RATE,
+            hue_threshold: float = HUE_THRESHOLD,
+            saturation_threshold: float = SATURATION_THRESHOLD,
+            brightness_threshold: float = BRIGHTNESS_THRESHOLD,
+            kelvin_threshold: int = KELVIN_THRESHOLD
+    ):
+        self.device_set: LifxDeviceSet = device_set
+        self.tick_rate: float = tick_rate
+        self.hue_threshold: float = hue_threshold
+        self.saturation_threshold: float = saturation_threshold
+        self.brightness_threshold: float = brightness_threshold
+        self.kelvin_threshold: int = kelvin_threshold
+        self.last_sent: dict[tuple, dict] = {}
+        self.is_running: bool = False
+        self.frames: int = 0
+        self.late_frames: int = 0
+        self.sent: int = 0
+        self.suppressed: int = 0
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'frames': self.frames,
+            'late_frames': self.late_frames,
+            'sent': self.sent,
+            'suppressed': self.suppressed
+        }
+
+    def is_perceptible(self, previous: dict | None, color: dict) -> bool:
+        if previous is None:
+            return True
+        hue_distance = abs(color['hue'] - previous['hue']) % 360
+        hue_distance = min(hue_distance, 360 - hue_distance) * max(color['saturation'], previous['saturation'])
+        return (
+            hue_distance > self.hue_threshold
+            or abs(color['saturation'] - previous['saturation']) > self.saturation_threshold
+            or abs(color['brightness'] - previous['brightness']) > self.brightness_threshold
+            or abs(color['kelvin'] - previous['kelvin']) > self.kelvin_threshold
+        )
+
+    def render_frame(self, color: dict, timestamp: float = None) -> None:
+        self.frames += 1
+        Globals.tracer.record('transmit', timestamp)
+        for device in self.device_set.devices:
+            if not self.is_perceptible(self.last_sent.get(device.address), color):
+                self.suppressed += 1
+                continue
+            device.publish_color(timestamp, **color)
+            self.last_sent[device.address] = color
+            self.sent += 1
+
+    # Colors go through the per-device output workers, acknowledged unless streaming.
+    # Ticks are scheduled against absolute deadlines, a tick late by a whole period restarts the schedule
+    # instead of bursting to catch up.
+    async def start(self, streaming: bool = True) -> None:
+        self.is_running = True
+        self.device_set.start_output_workers(acknowledged=not streaming)
+        converter = self.device_set.converter
+        hue_channel = converter.hue_channel
+        controllers = converter.controllers
+        period = 1 / self.tick_rate
+        version = hue_channel.version
+        next_tick = time.monotonic()
+        try:
+            while self.is_running:
+                next_tick += period
+                await asyncio.sleep(next_tick - time.monotonic())
+                if time.monotonic() - next_tick > period:
+                    self.late_frames += 1
+                    next_tick = time.monotonic()
+                hue_changed = hue_channel.version != version
+                if not hue_changed and not controllers.is_pending:
+                    continue
+                version = hue_channel.version
+                color = {**FrameScheduler.DEFAULT_COLOR, **LifxDeviceSet.color_for_hue(hue_channel.value)}
+                color = controllers.modulate(color)
+                if hue_changed:
+                    color['duration'] = converter.transition_duration
+                    timestamp = hue_channel.timestamp
+                else:
+                    color['duration'] = int(period * 1000)  # controllers glide from one frame to the next
+                    timestamp = controllers.timestamp
+                self.render_frame(color, timestamp)
+                self.device_set.current_hue = hue_channel.value
+        finally:
+            self.device_set.stop_output_workers()
+
+    def stop(self) -> None:
+        self.is_running = False
@@ -1,7 +1,11 @@
+from event_journal import EventJournal
+from latency_tracer import LatencyTracer
 from message_router import MessageRouter
 from notes_to_hue_converter import NotesToHueConverter
 
 
 class Globals:
-    router = MessageRouter()
+    tracer = LatencyTracer()
+    journal = EventJournal()  # disabled until main opens a journal file
+    router = MessageRouter(tracer, journal)
     converter = NotesToHueConverter()
@@ -0,0 +1,139 @@
+import asyncio
+import sys
+import time
+
+from event_journal import JournalReader, JournalRecordType
+from globals import Globals
+from lifx_device import LifxDevice
+from lifx_device_set import LifxDeviceSet
+from message_encoder import MessageEncoder
+from message_router import MessageRouter
+from midi_handler import MidiHandler
+from notes_to_hue_converter import NotesToHueConverter
+
+
+# Router without a socket: packets are counted and kept instead of sent, and every acknowledged message
+# is acknowledged at once, so replays are deterministic and never wait on the network.
+class StandInRouter(MessageRouter):
+    def __init__(self, tracer=None, journal=None):
+        super().__init__(tracer, journal)
+        self.sent: list[tuple[bytes, tuple]] = []
+
+    @staticmethod
+    def create_socket() -> None:
+        return None
+
+    async def open_transport(self) -> None:
+        pass
+
+    def close_transport(self) -> None:
+        pass
+
+    def send(self, packet: bytes, address: tuple, timestamp: float = None) -> None:
+        self.sent.append((bytes(packet), address))
+        self.tracer.record('send', timestamp)
+
+    async def send_and_await_response(
+            self,
+            encoder: MessageEncoder,
+            device,
+            timeout: float = MessageRouter.RESPONSE_TIMEOUT
+    ) -> dict:
+        packet = encoder.generate_packed_message()
+        self.tracer.record('encode', encoder.timestamp)
+        self.send(packet, device.address, encoder.timestamp)
+        if encoder.res_required + encoder.ack_required == 0:
+            return {}
+        self.tracer.record('ack', encoder.timestamp)
+        return {'payload': {'acknowledgement': True}}
+
+
+# Feeds the MIDI events of a journal back through fresh converters and device set transmit loops, with the
+# stand-in router in place of the network, at the recorded speed times speed, or as fast as possible when
+# speed is 0. The converters' hues are compared with the recorded ones. A session with ROUTE records, as
+# recorded by a Stage, gets one handler per MIDI input port and one converter and device set per route;
+# otherwise channel 0 of port 0 drives every device that was sent a packet. Each session of the journal starts
+# from fresh state, and events keep their recorded spacing as timestamps, so onset estimates and fade
+# durations are reproduced at any speed. Stage latencies are only meaningful at speed 1.
+class JournalReplay:
+    def __init__(self, path: str):
+        self.journal = JournalReader(path)
+
+    async def replay(self, speed: float = 1) -> dict:
+        Globals.tracer.reset()
+        Globals.router = StandInRouter(Globals.tracer)
+        totals = {'sessions': 0}
+        for session in self.journal.sessions():
+            for key, value in (await self.replay_session(session, speed)).items():
+                totals[key] = totals.get(key, 0) + value
+            totals['sessions'] += 1
+        return totals
+
+    async def replay_session(self, records: list, speed: float = 1) -> dict:
+        midi_records = JournalReader.of_type(records, JournalRecordType.MIDI_IN)
+        recorded_hues = [record.hue for record in JournalReader.of_type(records, JournalRecordType.HUE)]
+        sent_packets = JournalReader.of_type(records, JournalRecordType.PACKET_SENT)
+        sent_before = len(Globals.router.sent)
+
+        routes: dict[tuple, list[tuple]] = {}
+        for record in JournalReader.of_type(records, JournalRecordType.ROUTE):
+            midi_input_index, channel, addresses = record.route
+            routes.setdefault((midi_input_index, channel), []).extend(addresses)
+        if not routes:
+            routes[(0, 0)] = sorted({
+                record.address for record in sent_packets if record.address[0] != '255.255.255.255'
+            })
+
+        handlers: dict[int, MidiHandler] = {}
+        device_sets: list[LifxDeviceSet] = []
+        for (midi_input_index, channel), addresses in routes.items():
+            converter = NotesToHueConverter()
+            handlers.setdefault(midi_input_index, MidiHandler(midi_input_index, {})).routes[channel] = converter
+            device_set = LifxDeviceSet(converter)
+            device_set.devices = [LifxDevice(address) for address in addresses]
+            device_sets.append(device_set)
+        transmitting = [
+            asyncio.create_task(device_set.start_transmitting_converter_hue_to_all_devices(streaming=True))
+            for device_set in device_sets
+        ]
+        await asyncio.sleep(0)
+
+        replayed_hues = []
+        start_time = time.monotonic()
+        first_time = midi_records[0].time if midi_records else 0
+        for record in midi_records:
+            handler = handlers.get(record.address[1])
+            converter = None if handler is None else handler.converter_for(record.message[0])
+            if converter is None:
+                continue
+            if speed > 0:
+                await asyncio.sleep(start_time + (record.time - first_time) / speed - time.monotonic())
+            previous_hue = converter.current_hue
+            await handler.process_message(record.message, start_time + record.time - first_time, converter)
+            if converter.current_hue != previous_hue:
+                replayed_hues.append(converter.current_hue)
+        elapsed = time.monotonic() - start_time
+
+        for device_set in device_sets:
+            await device_set.async_set_transmitting(False)
+            device_set.converter.hue_channel.publish(device_set.converter.current_hue)  # wakes the loop to exit
+        await asyncio.gather(*transmitting)
+        return {
+            'midi_events': len(midi_records),
+            'recorded_hues': len(recorded_hues),
+            'replayed_hues': len(replayed_hues),
+            'hue_mismatches': sum(1 for a, b in zip(recorded_hues, replayed_hues) if a != b)
+            + abs(len(recorded_hues) - len(replayed_hues)),
+            'recorded_packets': len(sent_packets),
+            'replayed_packets': len(Globals.router.sent) - sent_before,
+            'seconds': elapsed
+        }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print('Usage: python journal_replay.py <journal> [speed]')
+        sys.exit(1)
+    replay = JournalReplay(sys.argv[1])
+    print(asyncio.run(replay.replay(float(sys.argv[2]) if len(sys.argv) > 2 else 1)))
+    print(Globals.tracer.dump())
@@ -0,0 +1,73 @@
+import math
+import time
+
+
+# Log-bucketed histogram: recording is one log and one list increment, percentiles are accurate to a bucket width.
+class LatencyHistogram:
+    __slots__ = ('buckets', 'count', 'max')
+
+    MIN_SECONDS: float = 1e-6
+    GROWTH: float = 1.05  # bucket width, 5%
+    BUCKET_COUNT: int = 400  # up to about 300 seconds
+
+    def __init__(self):
+        self.buckets: list[int] = [0] * LatencyHistogram.BUCKET_COUNT
+        self.count: int = 0
+        self.max: float = 0
+
+    def record(self, seconds: float) -> None:
+        self.count += 1
+        if seconds > self.max:
+            self.max = seconds
+        if seconds <= LatencyHistogram.MIN_SECONDS:
+            index = 0
+        else:
+            index = int(math.log(seconds / LatencyHistogram.MIN_SECONDS, LatencyHistogram.GROWTH)) + 1
+        self.buckets[min(index, LatencyHistogram.BUCKET_COUNT - 1)] += 1
+
+    def percentile(self, p: float) -> float:
+        if self.count == 0:
+            return 0
+        rank = math.ceil(self.count * p / 100)
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(self.max, LatencyHistogram.MIN_SECONDS * LatencyHistogram.GROWTH ** index)
+        return self.max
+
+
+# Stage latencies measured from the monotonic timestamp of the MIDI event that caused them.
+class LatencyTracer:
+    def __init__(self, enabled: bool = True):
+        self.enabled: bool = enabled
+        self.histograms: dict[str, LatencyHistogram] = {}
+
+    def record(self, stage: str, since: float | None) -> None:
+        if not self.enabled or since is None:
+            return
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = LatencyHistogram()
+        histogram.record(time.monotonic() - since)
+
+    def reset(self) -> None:
+        self.histograms = {}
+
+    @property
+    def summary(self) -> dict:
+        return {
+            stage: {
+                'count': histogram.count,
+                'p50_ms': histogram.percentile(50) * 1000,
+                'p99_ms': histogram.percentile(99) * 1000,
+                'max_ms': histogram.max * 1000
+            }
+            for stage, histogram in self.histograms.items()
+        }
+
+    def dump(self) -> str:
+        s = f'{"Stage":<12}{"Count":>10}{"p50 ms":>10}{"p99 ms":>10}{"max ms":>10}\n'
+        for stage, stats in self.summary.items():
+            s += f'{stage:<12}{stats["count"]:>10}{stats["p50_ms"]:>10.3f}{stats["p99_ms"]:>10.3f}{stats["max_ms"]:>10.3f}\n'
+        return s
@@ -0,0 +1,28 @@
+import asyncio
+
+
+# Versioned latest-value cell: publishers overwrite the value, subscribers remember the version they last saw
+# and wake only when it changes. Intermediate values between two reads are skipped, never queued.
+class LatestValue:
+    def __init__(self, value=None):
+        self.value = value
+        self.version: int = 0
+        self.timestamp: float | None = None  # monotonic time of the event behind the latest value, if known
+        self.changed: asyncio.Future | None = None
+
+    def publish(self, value, timestamp: float = None) -> None:
+        self.value = value
+        self.timestamp = timestamp
+        self.version += 1
+        if self.changed is not None:
+            if not self.changed.done():
+                self.changed.set_result(None)
+            self.changed = None
+
+    async def wait_for_change(self, version: int) -> tuple[int, object]:
+        while self.version == version:
+            if self.changed is None:
+                self.changed = asyncio.get_running_loop().create_future()
+            # shielded so that a cancelled subscriber does not cancel the shared future for the others
+            await asyncio.shield(self.changed)
+        return self.version, self.value
@@ -1,14 +1,35 @@
 import asyncio
+import time
 
 from globals import Globals
-from message_encoder import MessageEncoder
+from message_encoder import MessageEncoder, Waveform
 from message_maker import MessageMaker
+from message_router import MessageRouter, ResponseTimeout
 
 
 class LifxDevice:
-    def __init__(self, address: tuple[str] = None):
-        self.lock = asyncio.Lock()
+    MAX_MESSAGES_PER_SECOND: float = 20
+    STATE_TTL: float = 10  # seconds a cached label, power or color is trusted without asking the device
+    LIGHT_STATE_FIELDS: tuple = ('label', 'power', 'hue', 'saturation', 'brightness', 'kelvin')
+
+    def __init__(self, address: tuple[str] = None, target: str = None):
         self.address: tuple[str] = address
+        self.target: str | None = target  # serial reported by the device, as a hex string
+
+        # mirror of the device state, fed by the router with every State packet and by confirmed Set commands
+        self.state: dict = {}
+        self.state_updated: dict[str, float] = {}
+
+        # output worker: a target color slot where the latest color wins, drained at most MAX_MESSAGES_PER_SECOND
+        self.color_packet = MessageMaker.SetColorPacket()
+        self.next_color: dict | None = None
+        self.next_color_timestamp: float | None = None
+        self.color_ready = asyncio.Event()
+        self.is_outputting: bool = False
+        self.published_at: float = 0
+        self.delivery_lag: float = 0  # seconds from publishing the last delivered color to sending or confirming it
+        self.coalesced_colors: int = 0
+        self.timeouts: int = 0
 
     def __str__(self):
         return f'Address: {self.address[0]}'
@@ -23,13 +44,37 @@ class LifxDevice:
         kwargs = {} if kwargs is None else kwargs
         return await getattr(self, method)(**kwargs)
 
-    async def get(self, prop: str = 'power'):
+    async def get(self, prop: str = 'power', fresh: bool = False):
+        if fresh:
+            self.expire_state()
         return await getattr(self, prop)
 
-    async def send_and_await_response(self, encoder: MessageEncoder):
-        async with self.lock:
-            response = await Globals.router.send_and_await_response(encoder, self)
-            return response['payload']
+    async def send_and_await_response(self, encoder: MessageEncoder, timeout: float = MessageRouter.RESPONSE_TIMEOUT):
+        response = await Globals.router.send_and_await_response(encoder, self, timeout)
+        return response['payload']
+
+    def update_state(self, state: dict) -> None:
+        now = time.monotonic()
+        for field in LifxDevice.LIGHT_STATE_FIELDS:
+            if field in state:
+                self.state[field] = state[field]
+                self.state_updated[field] = now
+
+    def expire_state(self) -> None:
+        self.state_updated.clear()
+
+    def cached_state(self, fields: tuple) -> dict | None:
+        now = time.monotonic()
+        for field in fields:
+            if now - self.state_updated.get(field, -LifxDevice.STATE_TTL) >= LifxDevice.STATE_TTL:
+                return None
+        return {field: self.state[field] for field in fields}
+
+    async def read_state(self, encoder: MessageEncoder, fields: tuple) -> dict:
+        cached = self.cached_state(fields)
+        if cached is not None:
+            return cached
+        return await self.send_and_await_response(encoder)
 
     @property
     async def info(self) -> str:
@@ -48,15 +93,16 @@ class LifxDevice:
 
     @property
     async def label(self) -> dict:
-        return await self.send_and_await_response(MessageMaker.GetLabel())
+        return await self.read_state(MessageMaker.GetLabel(), ('label',))
 
     @property
     async def power(self) -> dict:
-        return await self.send_and_await_response(MessageMaker.GetPower())
+        return await self.read_state(MessageMaker.GetPower(), ('power',))
 
     async def set_power(self, power_level: int = MessageEncoder.MAX_UINT16) -> dict:
         await self.send_and_await_response(MessageMaker.SetPower(power_level))
-        return await self.power
+        self.update_state({'power': power_level})
+        return {'power': power_level}
 
     async def turn_on(self) -> dict:
         return await self.set_power(MessageEncoder.MAX_UINT16)
@@ -65,14 +111,14 @@ class LifxDevice:
         return await self.set_power(0)
 
     async def toggle_power(self) -> dict:
-        if await self.power == 0:
+        if (await self.power)['power'] == 0:
             return await self.turn_on()
         else:
             return await self.turn_off()
 
     @property
     async def color(self):
-        return await self.send_and_await_response(MessageMaker.GetColor())
+        return await self.read_state(MessageMaker.GetColor(), LifxDevice.LIGHT_STATE_FIELDS)
 
     async def set_color(
             self,
@@ -80,13 +126,121 @@ class LifxDevice:
             saturation: int = 1,
             brightness: int = 1,
             kelvin: int = 4000,
-            duration: int = 100
+            duration: int = 100,
+            timestamp: float = None
     ):
-
-        return await self.send_and_await_response(MessageMaker.SetColor(
+        encoder = MessageMaker.SetColor(
             hue=hue,
             saturation=saturation,
             brightness=brightness,
             kelvin=kelvin,
             duration=duration
-        ))
+        )
+        encoder.timestamp = timestamp
+        response = await self.send_and_await_response(encoder)
+        self.confirm_color(hue, saturation, brightness, kelvin)
+        return response
+
+    def confirm_color(
+            self,
+            hue: float = 0,
+            saturation: float = 1,
+            brightness: float = 1,
+            kelvin: int = 4000,
+            duration: int = None
+    ) -> None:
+        color = MessageMaker.hsbk(hue, saturation, brightness, kelvin)
+        self.update_state(dict(zip(('hue', 'saturation', 'brightness', 'kelvin'), color)))
+
+    # Starts an effect that the bulb runs on its own, one packet for any number of cycles.
+    # Components left as None are not animated, which sends SetWaveformOptional instead of SetWaveform.
+    async def set_waveform(
+            self,
+            hue: float = None,
+            saturation: float = None,
+            brightness: float = None,
+            kelvin: int = None,
+            period: int = 1000,
+            cycles: float = 1,
+            skew_ratio: float = 0.5,
+            waveform: Waveform = Waveform.SINE,
+            transient: bool = True
+    ):
+        components = {'hue': hue, 'saturation': saturation, 'brightness': brightness, 'kelvin': kelvin}
+        encoder = MessageMaker.waveform(
+            period=period,
+            cycles=cycles,
+            skew_ratio=skew_ratio,
+            waveform=waveform,
+            transient=transient,
+            **components
+        )
+        response = await self.send_and_await_response(encoder)
+        if not transient:
+            color = MessageMaker.hsbk(encoder.hue, encoder.saturation, encoder.brightness, encoder.kelvin)
+            color = dict(zip(components, color))
+            self.update_state({field: color[field] for field, value in components.items() if value is not None})
+        return response
+
+    # Any SetColor replaces a running waveform, so the effect is stopped by setting the last known color again.
+    async def stop_waveform(self, duration: int = 0):
+        state = await self.color
+        return await self.set_color(
+            hue=state['hue'] * 360 / MessageEncoder.MAX_UINT16,
+            saturation=state['saturation'] / MessageEncoder.MAX_UINT16,
+            brightness=state['brightness'] / MessageEncoder.MAX_UINT16,
+            kelvin=state['kelvin'],
+            duration=duration
+        )
+
+    def publish_color(self, timestamp: float = None, **color) -> None:
+        if self.next_color is None:
+            self.published_at = time.monotonic()
+        else:
+            self.coalesced_colors += 1
+        self.next_color = color
+        self.next_color_timestamp = timestamp
+        self.color_ready.set()
+
+    # seconds the oldest color not yet delivered has been waiting, zero when the device is up to date
+    @property
+    def lag(self) -> float:
+        return 0 if self.next_color is None else time.monotonic() - self.published_at
+
+    @property
+    def output_stats(self) -> dict:
+        return {
+            'lag': self.lag,
+            'delivery_lag': self.delivery_lag,
+            'coalesced_colors': self.coalesced_colors,
+            'timeouts': self.timeouts
+        }
+
+    # Long-lived output worker that drains the target color slot at this device's own pace.
+    # Acknowledged output waits for each ack before taking the next color, streaming output sends and moves on.
+    async def start_output(self, acknowledged: bool = False) -> None:
+        self.is_outputting = True
+        await Globals.router.open_transport()
+        while self.is_outputting:
+            await self.color_ready.wait()
+            self.color_ready.clear()
+            color, self.next_color = self.next_color, None
+            if color is None:
+                continue
+            timestamp, published_at = self.next_color_timestamp, self.published_at
+            sent_at = time.monotonic()
+            if acknowledged:
+                try:
+                    await self.set_color(timestamp=timestamp, **color)
+                except ResponseTimeout:
+                    self.timeouts += 1
+            else:
+                packet = self.color_packet.pack(**color)
+                Globals.tracer.record('encode', timestamp)
+                Globals.router.send(packet, self.address, timestamp)
+            self.delivery_lag = time.monotonic() - published_at
+            await asyncio.sleep(sent_at + 1 / LifxDevice.MAX_MESSAGES_PER_SECOND - time.monotonic())
+
+    def stop_output(self) -> None:
+        self.is_outputting = False
+        self.color_ready.set()
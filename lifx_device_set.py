@@ -1,19 +1,48 @@
 import asyncio
+import json
 import time
 
 from globals import Globals
 from lifx_device import LifxDevice
+from message_encoder import Waveform
+from message_maker import MessageMaker
+from message_router import MessageRouter, ResponseTimeout
+from notes_to_hue_converter import NotesToHueConverter
 
 
 class LifxDeviceSet:
     PORT = 56700
+    BROADCAST_ADDRESS = ('<broadcast>', PORT)
+    CACHE_PATH: str = 'devices_cache.json'
 
-    def __init__(self):
+    def __init__(self, converter: NotesToHueConverter = None):
         print('Initializing LIFX Device Set')
         self.lock = asyncio.Lock()
-        self.devices: list[LifxDevice] = []
+        self.converter: NotesToHueConverter = Globals.converter if converter is None else converter
+        self._devices: list[LifxDevice] = []
         self.is_transmitting: bool = False
+        self.is_outputting: bool = False
+        self.acknowledged_output: bool = False
+        self.is_rediscovering: bool = False
+        self.rediscovery: asyncio.Task | None = None
+        self.missed_discoveries: dict[tuple, int] = {}
         self.current_hue: float = 0
+        self.broadcast_packet = MessageMaker.SetColorPacket()
+        self.acknowledged_broadcast_packet = MessageMaker.SetColorPacket(ack_required=True)
+
+    # devices are registered with the router while they belong to a set, so it only updates the state of bulbs in use
+    @property
+    def devices(self) -> list[LifxDevice]:
+        return self._devices
+
+    @devices.setter
+    def devices(self, devices: list[LifxDevice]) -> None:
+        for device in self._devices:
+            if device not in devices:
+                Globals.router.unregister_device(device)
+        for device in devices:
+            Globals.router.register_device(device)
+        self._devices = devices
 
     @property
     async def info(self) -> str:
@@ -24,33 +53,254 @@ class LifxDeviceSet:
             device_set_info += f'\n{info}'
         return device_set_info
 
-    async def discover_devices(self, discovery_timeout: float = 2) -> list[LifxDevice]:
+    async def discover_devices(self, discovery_timeout: float = 2, addresses: list[tuple] = None) -> list[LifxDevice]:
         print(f'Initiating async discovery for {discovery_timeout} seconds...')
-        responses = await Globals.router.discover_devices(discovery_timeout)
-        responses = sorted(responses.items(), key=lambda res: res[1]['label'])
-        devices = [LifxDevice(address) for address, res in responses]
+        responses = await Globals.router.discover_devices(discovery_timeout, addresses)
+        devices = LifxDeviceSet.devices_from_responses(responses)
+        LifxDeviceSet.save_device_cache(devices)
         print(f'Async discovery completed.')
         return devices
 
+    @staticmethod
+    def devices_from_responses(responses: dict) -> list[LifxDevice]:
+        devices = []
+        for address, res in sorted(responses.items(), key=lambda res: res[1]['label']):
+            device = LifxDevice(address, target=res.get('target'))
+            device.update_state({'label': res['label']})
+            devices.append(device)
+        return devices
+
+    # an empty discovery never replaces a cache that still lists devices
+    @staticmethod
+    def save_device_cache(devices: list[LifxDevice], path: str = None) -> None:
+        if len(devices) == 0:
+            return
+        path = LifxDeviceSet.CACHE_PATH if path is None else path
+        entries = [
+            {'address': list(device.address), 'target': device.target, 'label': device.state.get('label', '')}
+            for device in devices
+        ]
+        with open(path, 'w') as cache_file:
+            json.dump(entries, cache_file, indent=2)
+
+    @staticmethod
+    def load_cached_devices(path: str = None) -> list[LifxDevice]:
+        path = LifxDeviceSet.CACHE_PATH if path is None else path
+        try:
+            with open(path) as cache_file:
+                entries = json.load(cache_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return []
+        responses = {tuple(entry['address']): {'label': entry['label'], 'target': entry['target']} for entry in entries}
+        print(f'Loaded {len(responses)} devices from {path}.')
+        return LifxDeviceSet.devices_from_responses(responses)
+
+    def add_device(self, device: LifxDevice) -> None:
+        self.devices = self.devices + [device]
+        if self.is_outputting:
+            asyncio.create_task(device.start_output(self.acknowledged_output))
+
+    def remove_device(self, device: LifxDevice) -> None:
+        self.devices = [d for d in self.devices if d is not device]
+        device.stop_output()
+
+    # adds devices that answered for the first time, drops devices that missed missed_limit discoveries in a row
+    # and rewrites the device cache only when either happened
+    async def rediscover_devices(
+            self,
+            discovery_timeout: float = 1,
+            missed_limit: int = 3,
+            addresses: list[tuple] = None
+    ) -> None:
+        responses = await Globals.router.discover_devices(discovery_timeout, addresses)
+        known = {device.address: device for device in self.devices}
+        changed = False
+        for device in LifxDeviceSet.devices_from_responses(
+                {address: res for address, res in responses.items() if address not in known}):
+            print(f'Discovered new device: {device}')
+            self.add_device(device)
+            changed = True
+
+        for address, device in known.items():
+            if address in responses:
+                self.missed_discoveries.pop(address, None)
+                continue
+            self.missed_discoveries[address] = self.missed_discoveries.get(address, 0) + 1
+            if self.missed_discoveries[address] >= missed_limit:
+                print(f'Device disappeared: {device}')
+                del self.missed_discoveries[address]
+                self.remove_device(device)
+                changed = True
+        if changed:
+            LifxDeviceSet.save_device_cache(self.devices)
+
+    # stop_rediscovery cancels the task, so no discovery reopens the router once shutdown has begun
+    async def start_rediscovery(self, interval: float = 30, discovery_timeout: float = 1) -> None:
+        self.is_rediscovering = True
+        self.rediscovery = asyncio.current_task()
+        try:
+            while self.is_rediscovering:
+                await asyncio.sleep(interval)
+                if not self.is_rediscovering:
+                    break
+                await self.rediscover_devices(discovery_timeout)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.rediscovery = None
+
+    def stop_rediscovery(self) -> None:
+        self.is_rediscovering = False
+        if self.rediscovery is not None:
+            self.rediscovery.cancel()
+
     async def async_set_transmitting(self, transmitting: bool = True):
         async with self.lock:
             self.is_transmitting = transmitting
 
-    async def all_devices_do(self, method: str = 'set_power', args: dict = None) -> tuple:
-        return await asyncio.gather(*[device.do(method, args) for device in self.devices])
+    # with return_exceptions, a device that failed to answer shows up as its exception instead of aborting the rest
+    async def all_devices_do(
+            self,
+            method: str = 'set_power',
+            args: dict = None,
+            return_exceptions: bool = False
+    ) -> tuple:
+        return await asyncio.gather(
+            *[device.do(method, args) for device in self.devices], return_exceptions=return_exceptions
+        )
+
+    async def all_devices_get(self, prop: str = 'service', return_exceptions: bool = False) -> tuple:
+        return await asyncio.gather(
+            *[device.get(prop) for device in self.devices], return_exceptions=return_exceptions
+        )
 
-    async def all_devices_get(self, prop: str = 'service') -> tuple:
-        return await asyncio.gather(*[device.get(prop) for device in self.devices])
+    def all_devices_publish(self, color: dict, timestamp: float = None) -> None:
+        for device in self.devices:
+            device.publish_color(timestamp, **color)
 
-    async def start_transmitting_converter_hue_to_all_devices(self) -> None:
+    @property
+    def output_stats(self) -> dict:
+        return {device.address: device.output_stats for device in self.devices}
+
+    def slowest_devices(self, count: int = 3) -> list[LifxDevice]:
+        return sorted(self.devices, key=lambda device: (device.lag, device.delivery_lag), reverse=True)[:count]
+
+    # One tagged broadcast SetColor reaches every bulb on the LAN, not only the ones in this set.
+    # With fallback, the broadcast asks for acks and devices that did not answer get a unicast SetColor.
+    # Returns the devices that could not be confirmed.
+    async def set_uniform_color(
+            self,
+            fallback: bool = False,
+            timeout: float = MessageRouter.RESPONSE_TIMEOUT,
+            timestamp: float = None,
+            **color
+    ) -> list[LifxDevice]:
+        await Globals.router.open_transport()
+        if not fallback:
+            Globals.router.send(self.broadcast_packet.pack(**color), LifxDeviceSet.BROADCAST_ADDRESS, timestamp)
+            return []
+
+        devices = self.devices
+        packet = self.acknowledged_broadcast_packet.pack(**color)
+        sequence = self.acknowledged_broadcast_packet.sequence
+        acks = [Globals.router.expect_response(device.address, sequence) for device in devices]
+        Globals.router.send(packet, LifxDeviceSet.BROADCAST_ADDRESS, timestamp)
+        results = await asyncio.gather(
+            *[Globals.router.wait_for_response(ack, device.address, sequence, timeout=timeout)
+              for ack, device in zip(acks, devices)],
+            return_exceptions=True
+        )
+        Globals.tracer.record('ack', timestamp)
+        missed = [device for device, result in zip(devices, results) if isinstance(result, ResponseTimeout)]
+        for device, result in zip(devices, results):
+            if not isinstance(result, Exception):
+                device.confirm_color(**color)
+        if len(missed) == 0:
+            return []
+
+        results = await asyncio.gather(*[device.set_color(**color) for device in missed], return_exceptions=True)
+        return [device for device, result in zip(missed, results) if isinstance(result, ResponseTimeout)]
+
+    # One SetWaveform per device, or a single tagged broadcast for every bulb on the LAN.
+    # Returns the devices that did not acknowledge the effect.
+    async def start_waveform(self, broadcast: bool = False, **waveform) -> list[LifxDevice]:
+        if broadcast:
+            await Globals.router.open_transport()
+            encoder = MessageMaker.waveform(**waveform)
+            Globals.router.send(encoder.packed_message, LifxDeviceSet.BROADCAST_ADDRESS)
+            return []
+        devices = self.devices
+        results = await asyncio.gather(
+            *[device.set_waveform(**waveform) for device in devices],
+            return_exceptions=True
+        )
+        return [device for device, result in zip(devices, results) if isinstance(result, ResponseTimeout)]
+
+    async def pulse(self, brightness: float = 1, period: int = 200, cycles: float = 1, **options) -> list[LifxDevice]:
+        return await self.start_waveform(
+            brightness=brightness, period=period, cycles=cycles, waveform=Waveform.PULSE, **options
+        )
+
+    async def breathe(
+            self,
+            brightness: float = 0.3,
+            period: int = 2000,
+            cycles: float = 1000,
+            **options
+    ) -> list[LifxDevice]:
+        return await self.start_waveform(
+            brightness=brightness, period=period, cycles=cycles, waveform=Waveform.SINE, **options
+        )
+
+    async def stop_waveforms(self) -> tuple:
+        return await asyncio.gather(*[device.stop_waveform() for device in self.devices], return_exceptions=True)
+
+    @staticmethod
+    def color_for_hue(hue: float) -> dict:
+        if hue == -1:
+            return {'saturation': 0, 'kelvin': 5000}
+        return {'saturation': 1, 'hue': hue}
+
+    def start_output_workers(self, acknowledged: bool = False) -> None:
+        self.is_outputting = True
+        self.acknowledged_output = acknowledged
+        for device in self.devices:
+            asyncio.create_task(device.start_output(acknowledged))
+
+    def stop_output_workers(self) -> None:
+        self.is_outputting = False
+        for device in self.devices:
+            device.stop_output()
+
+    # Without broadcast, every device has its own output worker, so the slowest bulb never holds back the rest.
+    # Streaming sends unacknowledged packets, otherwise each worker waits for its device's ack.
+    async def start_transmitting_converter_hue_to_all_devices(
+            self,
+            streaming: bool = False,
+            broadcast: bool = False
+    ) -> None:
         await self.async_set_transmitting(True)
-        while self.is_transmitting:
-            new_hue = await Globals.converter.async_get_current_hue()
-            if new_hue == self.current_hue:
-                await asyncio.sleep(0)
-            elif new_hue == -1:
-                await self.all_devices_do('set_color', {'saturation': 0, 'kelvin': 5000})
-            else:
-                await self.all_devices_do('set_color', {'saturation': 1, 'hue': new_hue})
-            async with self.lock:
-                self.current_hue = new_hue
+        if not broadcast:
+            self.start_output_workers(acknowledged=not streaming)
+
+        version = 0
+        try:
+            while self.is_transmitting:
+                version, new_hue = await self.converter.hue_channel.wait_for_change(version)
+                timestamp = self.converter.hue_channel.timestamp
+                Globals.tracer.record('transmit', timestamp)
+                color = self.converter.controllers.modulate(self.color_for_hue(new_hue))
+                color['duration'] = self.converter.transition_duration
+                if broadcast:
+                    try:
+                        await self.set_uniform_color(fallback=not streaming, timestamp=timestamp, **color)
+                    except ResponseTimeout as e:
+                        print(e)
+                    if streaming:
+                        await asyncio.sleep(1 / LifxDevice.MAX_MESSAGES_PER_SECOND)
+                else:
+                    self.all_devices_publish(color, timestamp)
+                async with self.lock:
+                    self.current_hue = new_hue
+        finally:
+            self.stop_output_workers()
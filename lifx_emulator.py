@@ -0,0 +1,211 @@
+import asyncio
+import random
+import struct
+import sys
+import time
+
+from message_decoder import MessageDecoder, DecodedMessage, IncompleteHeader
+from message_encoder import MessageEncoder, MessageType, PacketTemplate
+from message_maker import MessageMaker
+
+
+class EmulatedLifxDevice(asyncio.DatagramProtocol):
+    STATE_PAYLOAD_FORMATS: dict = {
+        MessageType.STATE_SERVICE: "BI",  # service, port
+        MessageType.STATE_POWER: "H",  # level
+        MessageType.STATE_LABEL: "32s",  # label
+        MessageType.ACKNOWLEDGEMENT: "",
+        MessageType.LIGHT_STATE: "HHHH2xH32s8x"  # hue, saturation, brightness, kelvin, reserved, power, label, reserved
+    }
+
+    def __init__(
+            self,
+            label: str = 'Emulated',
+            serial: bytes = bytes(6),
+            latency: float = 0,
+            jitter: float = 0,
+            loss: float = 0,
+            rate_limit: float = None
+    ):
+        self.label: str = label
+        self.serial: bytes = serial
+        self.target: int = int.from_bytes(serial + bytes(2), byteorder='little')
+        self.power: int = 0
+        self.hue: int = 0
+        self.saturation: int = 0
+        self.brightness: int = MessageEncoder.MAX_UINT16
+        self.kelvin: int = 3500
+
+        self.latency: float = latency
+        self.jitter: float = jitter
+        self.loss: float = loss
+        self.rate_limit: float | None = rate_limit  # messages per second, anything above is dropped
+        self.tokens: float = 1 if rate_limit is None else rate_limit
+        self.last_refill: float = time.monotonic()
+
+        self.transport: asyncio.DatagramTransport | None = None
+        self.port: int = 0
+        self.received: int = 0
+        self.dropped: int = 0
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        self.transport = transport
+        self.port = transport.get_extra_info('sockname')[1]
+
+    def datagram_received(self, data: bytes, address: tuple) -> None:
+        try:
+            message = MessageDecoder.decode(data)
+        except IncompleteHeader:
+            return
+        self.received += 1
+        if not self.accept():
+            self.dropped += 1
+            return
+
+        responses = self.handle(message)
+        if len(responses) == 0:
+            return
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self.send, responses, address)
+        else:
+            self.send(responses, address)
+
+    def accept(self) -> bool:
+        if self.loss > 0 and random.random() < self.loss:
+            return False
+        if self.rate_limit is None:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.rate_limit, self.tokens + (now - self.last_refill) * self.rate_limit)
+        self.last_refill = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def send(self, responses: list[bytes], address: tuple) -> None:
+        if self.transport is None:
+            return
+        for response in responses:
+            self.transport.sendto(response, address)
+
+    def handle(self, message: DecodedMessage) -> list[bytes]:
+        state = None
+        match message.pkt_type:
+            case MessageType.GET_SERVICE.value:
+                state = (MessageType.STATE_SERVICE, 1, self.port)
+            case MessageType.GET_POWER.value:
+                state = (MessageType.STATE_POWER, self.power)
+            case MessageType.SET_POWER.value:
+                self.power = struct.unpack_from("<H", message.payload['payload'])[0]
+                if message.res_required:
+                    state = (MessageType.STATE_POWER, self.power)
+            case MessageType.GET_LABEL.value:
+                state = (MessageType.STATE_LABEL, self.label.encode())
+            case MessageType.GET_COLOR.value:
+                state = self.light_state
+            case MessageType.SET_COLOR.value:
+                color = struct.unpack_from(MessageMaker.SetColor.PAYLOAD_FORMAT, message.payload['payload'])
+                self.hue, self.saturation, self.brightness, self.kelvin = color[:4]
+                if message.res_required:
+                    state = self.light_state
+            case MessageType.SET_WAVEFORM.value | MessageType.SET_WAVEFORM_OPTIONAL.value:
+                # the effect itself is not animated, a non-transient waveform just ends on its color
+                waveform = message.payload
+                if not waveform['transient']:
+                    for field in ('hue', 'saturation', 'brightness', 'kelvin'):
+                        if waveform.get(f'set_{field}', True):
+                            setattr(self, field, waveform[field])
+                if message.res_required:
+                    state = self.light_state
+            case _:
+                return []
+
+        responses = []
+        if message.ack_required:
+            responses.append(self.pack(message, MessageType.ACKNOWLEDGEMENT))
+        if state is not None:
+            responses.append(self.pack(message, *state))
+        return responses
+
+    @property
+    def light_state(self) -> tuple:
+        return (
+            MessageType.LIGHT_STATE,
+            self.hue, self.saturation, self.brightness, self.kelvin,
+            self.power, self.label.encode()
+        )
+
+    def pack(self, request: DecodedMessage, msg_type: MessageType, *payload) -> bytes:
+        template = PacketTemplate.get(
+            msg_type,
+            EmulatedLifxDevice.STATE_PAYLOAD_FORMATS[msg_type],
+            tagged=False,
+            source_id=request.source
+        )
+        return bytes(template.pack(self.target, *payload, sequence=request.sequence))
+
+
+class LifxEmulatorFleet:
+    def __init__(
+            self,
+            count: int = 100,
+            host: str = '127.0.0.1',
+            base_port: int = 56800,
+            latency: float = 0,
+            jitter: float = 0,
+            loss: float = 0,
+            rate_limit: float = None
+    ):
+        self.host: str = host
+        self.base_port: int = base_port
+        self.devices: list[EmulatedLifxDevice] = [
+            EmulatedLifxDevice(
+                label=f'Emulated {i + 1:03d}',
+                serial=bytes.fromhex('d073d5') + (i + 1).to_bytes(3, byteorder='big'),
+                latency=latency,
+                jitter=jitter,
+                loss=loss,
+                rate_limit=rate_limit
+            )
+            for i in range(count)
+        ]
+        self.transports: list[asyncio.DatagramTransport] = []
+
+    @property
+    def addresses(self) -> list[tuple]:
+        return [(self.host, self.base_port + i) for i in range(len(self.devices))]
+
+    async def start(self) -> list[tuple]:
+        loop = asyncio.get_running_loop()
+        for device, address in zip(self.devices, self.addresses):
+            transport, _ = await loop.create_datagram_endpoint(lambda d=device: d, local_addr=address)
+            self.transports.append(transport)
+        return self.addresses
+
+    def close(self) -> None:
+        for transport in self.transports:
+            transport.close()
+        self.transports = []
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'received': sum(device.received for device in self.devices),
+            'dropped': sum(device.dropped for device in self.devices)
+        }
+
+
+async def main(count: int = 100) -> None:
+    fleet = LifxEmulatorFleet(count)
+    addresses = await fleet.start()
+    print(f'Emulating {count} LIFX devices on {fleet.host}:{addresses[0][1]}-{addresses[-1][1]}')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        fleet.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100))
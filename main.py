@@ -1,5 +1,6 @@
 import asyncio
 
+from frame_scheduler import FrameScheduler
 from globals import Globals
 from lifx_device_set import LifxDeviceSet
 from midi_handler import MidiHandler
@@ -11,19 +12,28 @@ async def main() -> None:
         return
 
     device_set = LifxDeviceSet()
-    device_set.devices = await device_set.discover_devices(0.5)
+    device_set.devices = LifxDeviceSet.load_cached_devices()
+    if len(device_set.devices) == 0:
+        device_set.devices = await device_set.discover_devices(0.5)
 
+    Globals.journal.open('journal.bin')
     await Globals.router.set_receiving(True)
     asyncio.create_task(Globals.router.start_receiving())
     asyncio.create_task(midi_in.start_receiving())
-    asyncio.create_task(device_set.start_transmitting_converter_hue_to_all_devices())
+    scheduler = FrameScheduler(device_set)
+    asyncio.create_task(scheduler.start(streaming=True))
+    asyncio.create_task(device_set.start_rediscovery())
 
     await asyncio.sleep(30)
     await midi_in.stop_receiving()
-    await device_set.async_set_transmitting(False)
+    scheduler.stop()
+    device_set.stop_rediscovery()
 
     print('Shutting down...')
     await asyncio.create_task(Globals.router.set_receiving(False))
+    Globals.journal.close()
+    print(scheduler.stats)
+    print(Globals.tracer.dump())
 
 
 if __name__ == "__main__":
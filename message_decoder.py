@@ -1,7 +1,6 @@
-import binascii
 import struct
 
-from message_encoder import MessageType
+from message_encoder import MessageType, Waveform
 
 
 class IncompleteHeader(Exception):
@@ -9,149 +8,158 @@ class IncompleteHeader(Exception):
         super().__init__("Insufficient data to unpack a Header")
 
 
+class DecodedMessage:
+    __slots__ = (
+        'size', 'protocol', 'addressable', 'tagged', 'source', 'target_bytes',
+        'res_required', 'ack_required', 'sequence', 'pkt_type', '_data', '_payload'
+    )
+
+    def __init__(self, data: memoryview, size, flags, source, target_bytes, response_flags, sequence, pkt_type):
+        self.size: int = size
+        self.protocol: int = flags & 0b111111111111
+        self.addressable: bool = (flags >> 12) & 0b1 != 0
+        self.tagged: bool = (flags >> 13) & 0b1 != 0
+        self.source: int = source
+        self.target_bytes: bytes = target_bytes
+        self.res_required: bool = response_flags & 0b1 != 0
+        self.ack_required: bool = (response_flags >> 1) & 0b1 != 0
+        self.sequence: int = sequence
+        self.pkt_type: int = pkt_type
+        self._data: memoryview = data
+        self._payload: dict | None = None
+
+    # dict style access, so callers can keep using message['payload']
+    def __getitem__(self, key: str):
+        return getattr(self, key)
+
+    @property
+    def target(self) -> str:
+        """returns the target Serial from the header."""
+        return self.target_bytes.hex()
+
+    @property
+    def payload(self) -> dict:
+        """decodes the payload on first access, using the decoder registered for the packet type."""
+        if self._payload is None:
+            decoder = PayloadDecoders.get(self.pkt_type)
+            if decoder is None:
+                raise ValueError(f"Unsupported packet type: {self.pkt_type}")
+            self._payload = decoder(self._data[MessageDecoder.HEADER.size:])
+        return self._payload
+
+    def __str__(self):
+        s = "size: " + str(self.size)
+        s += "; protocol: " + str(self.protocol)
+        s += "; addressable: " + str(self.addressable)
+        s += "; tagged: " + str(self.tagged)
+        s += "; source: " + str(self.source)
+        s += "; target: " + str(self.target)
+        s += "; res_required: " + str(self.res_required)
+        s += "; ack_required: " + str(self.ack_required)
+        s += "; sequence: " + str(self.sequence)
+        s += "; pkt_type: " + str(self.pkt_type)
+        s += "; payload: " + str(self.payload)
+        return s
+
+
 class MessageDecoder:
-    def __init__(self):
-        self._bts = None
+    # size, flags, source, target (6 bytes of serial + 2 padding), reserved, response flags, sequence,
+    # reserved, packet type, reserved
+    HEADER = struct.Struct("<HHL6s2x6xBB8xH2x")
 
-    def decode(self, data) -> dict:
-        if len(data) < 36:
+    @staticmethod
+    def decode(data) -> DecodedMessage:
+        if len(data) < MessageDecoder.HEADER.size:
             raise IncompleteHeader()
-        self._bts = data
-        return {
-            'size': self.size,
-            'protocol': self.protocol,
-            'addressable': self.addressable,
-            'tagged': self.tagged,
-            'source': self.source,
-            'target': self.target,
-            'res_required': self.res_required,
-            'ack_required': self.ack_required,
-            'sequence': self.sequence,
-            'pkt_type': self.pkt_type,
-            'payload': self.payload
-        }
-
-    def __getitem__(self, rng):
-        return self._bts[rng]
+        view = memoryview(data)
+        return DecodedMessage(view, *MessageDecoder.HEADER.unpack_from(view))
 
-    @property
-    def size(self):
-        """returns the size of the total message."""
-        return struct.unpack("<H", self[0:2])[0]
+    @staticmethod
+    def register_payload_decoder(msg_type: MessageType, decoder) -> None:
+        PayloadDecoders[msg_type.value] = decoder
 
-    @property
-    def protocol(self):
-        """returns the protocol version of the header."""
-        v = struct.unpack("<H", self[2:4])[0]
-        return v & 0b111111111111
 
-    @property
-    def addressable(self):
-        """returns whether the addressable bit is set."""
-        v = self[3]
-        v = v >> 4
-        return (v & 0b1) != 0
+def decode_raw_payload(payload_data: memoryview) -> dict:
+    return {'payload': bytes(payload_data)}
 
-    @property
-    def tagged(self):
-        """returns whether the tagged bit is set."""
-        v = self[3]
-        v = v >> 5
-        return (v & 0b1) != 0
 
-    @property
-    def source(self):
-        """returns then number used by clients to differentiate themselves from other clients"""
-        return struct.unpack("<I", self[4:8])[0]
+def decode_state_service(payload_data: memoryview) -> dict:
+    return {
+        'service': Services[payload_data[0]],
+        'port': int.from_bytes(payload_data[1:5], byteorder='little', signed=False)
+    }
 
-    @property
-    def target(self):
-        """returns the target Serial from the header."""
-        return binascii.hexlify(self[8:16][:6]).decode()
 
-    @property
-    def res_required(self):
-        """returns whether the response required bit is set in the header."""
-        v = self[22]
-        return (v & 0b1) != 0
+def decode_state_power(payload_data: memoryview) -> dict:
+    return {'power': int.from_bytes(payload_data[0:2], byteorder='little', signed=False)}
 
-    @property
-    def ack_required(self):
-        """returns whether the ack required bit is set in the header."""
-        v = self[22]
-        v = v >> 1
-        return (v & 0b1) != 0
 
-    @property
-    def sequence(self):
-        """returns the sequence ID from the header."""
-        return self[23]
+def decode_state_label(payload_data: memoryview) -> dict:
+    return {'label': bytes(payload_data).decode("utf-8").rstrip('\x00')}
 
-    @property
-    def pkt_type(self):
-        """returns the Payload ID for the accompanying payload in the message."""
-        return struct.unpack("<H", self[32:34])[0]
 
-    @property
-    def payload(self) -> dict:
-        payload_data = self[36:]
-        match self.pkt_type:
-            case MessageType.GET_SERVICE.value:  # 2
-                return {'payload': payload_data}
+def decode_acknowledgement(payload_data: memoryview) -> dict:
+    return {'acknowledgement': True}
 
-            case MessageType.STATE_SERVICE.value:  # 3
-                return {
-                    'service': Services[int(payload_data[0])],
-                    'port': int.from_bytes(payload_data[1:5], byteorder='little', signed=False)
-                }
 
-            case MessageType.GET_POWER.value:  # 20
-                return {'payload': payload_data}
+LIGHT_STATE = struct.Struct("<HHHH2xH32s")  # hue, saturation, brightness, kelvin, reserved, power, label
 
-            case MessageType.STATE_POWER.value:  # 22
-                return {'power': int.from_bytes(payload_data[0:2], byteorder='little', signed=False)}
 
-            case MessageType.GET_LABEL.value:  # 23
-                return {'payload': payload_data}
+def decode_light_state(payload_data: memoryview) -> dict:
+    hue, saturation, brightness, kelvin, power, label = LIGHT_STATE.unpack_from(payload_data)
+    return {
+        'label': label.decode("utf-8").rstrip('\x00'),
+        'power': power,
+        'hue': hue,
+        'saturation': saturation,
+        'brightness': brightness,
+        'kelvin': kelvin
+    }
 
-            case MessageType.STATE_LABEL.value:  # 25
-                return {'label': payload_data.decode("utf-8").rstrip('\x00')}
 
-            case MessageType.ACKNOWLEDGEMENT.value:  # 45
-                return {'acknowledgement': True}
+SET_WAVEFORM = struct.Struct("<xBHHHHIfhB")  # reserved, transient, hsbk, period, cycles, skew ratio, waveform
+SET_WAVEFORM_OPTIONAL = struct.Struct("<xBHHHHIfhBBBBB")  # SetWaveform, then set hue, saturation, brightness, kelvin
 
-            case MessageType.GET_COLOR.value:  # 101
-                return {'payload': payload_data}
 
-            case MessageType.SET_COLOR.value:  # 102
-                return {'payload': payload_data}
+def decode_set_waveform(payload_data: memoryview) -> dict:
+    transient, hue, saturation, brightness, kelvin, period, cycles, skew_ratio, waveform = \
+        SET_WAVEFORM.unpack_from(payload_data)
+    return {
+        'transient': transient != 0,
+        'hue': hue,
+        'saturation': saturation,
+        'brightness': brightness,
+        'kelvin': kelvin,
+        'period': period,
+        'cycles': cycles,
+        'skew_ratio': skew_ratio,
+        'waveform': Waveform(waveform)
+    }
 
-            case MessageType.LIGHT_STATE.value:  # 107
-                return {
-                    'label': payload_data[12:44].decode("utf-8").rstrip('\x00'),
-                    'power': int.from_bytes(payload_data[10:12], byteorder='little', signed=False),
-                    'hue': int.from_bytes(payload_data[0:2], byteorder='little', signed=False),
-                    'saturation': int.from_bytes(payload_data[2:4], byteorder='little', signed=False),
-                    'brightness': int.from_bytes(payload_data[4:6], byteorder='little', signed=False),
-                    'kelvin': int.from_bytes(payload_data[6:8], byteorder='little', signed=False)
-                }
 
-            case _:
-                raise ValueError(f"Unsupported packet type: {self.pkt_type}")
+def decode_set_waveform_optional(payload_data: memoryview) -> dict:
+    payload = decode_set_waveform(payload_data)
+    set_flags = SET_WAVEFORM_OPTIONAL.unpack_from(payload_data)[-4:]
+    for field, set_flag in zip(('set_hue', 'set_saturation', 'set_brightness', 'set_kelvin'), set_flags):
+        payload[field] = set_flag != 0
+    return payload
 
-    def __str__(self):
-        s = "size: " + str(self.size)
-        s += "; protocol: " + str(self.protocol)
-        s += "; addressable: " + str(self.addressable)
-        s += "; tagged: " + str(self.tagged)
-        s += "; source: " + str(self.source)
-        s += "; target: " + str(self.target)
-        s += "; res_required: " + str(self.res_required)
-        s += "; ack_required: " + str(self.ack_required)
-        s += "; sequence: " + str(self.sequence)
-        s += "; pkt_type: " + str(self.pkt_type)
-        s += "; payload: " + str(self.payload)
-        return s
+
+PayloadDecoders: dict = {
+    MessageType.GET_SERVICE.value: decode_raw_payload,  # 2
+    MessageType.STATE_SERVICE.value: decode_state_service,  # 3
+    MessageType.GET_POWER.value: decode_raw_payload,  # 20
+    MessageType.SET_POWER.value: decode_raw_payload,  # 21
+    MessageType.STATE_POWER.value: decode_state_power,  # 22
+    MessageType.GET_LABEL.value: decode_raw_payload,  # 23
+    MessageType.STATE_LABEL.value: decode_state_label,  # 25
+    MessageType.ACKNOWLEDGEMENT.value: decode_acknowledgement,  # 45
+    MessageType.GET_COLOR.value: decode_raw_payload,  # 101
+    MessageType.SET_COLOR.value: decode_raw_payload,  # 102
+    MessageType.SET_WAVEFORM.value: decode_set_waveform,  # 103
+    MessageType.LIGHT_STATE.value: decode_light_state,  # 107
+    MessageType.SET_WAVEFORM_OPTIONAL.value: decode_set_waveform_optional  # 119
+}
 
 
 Services: dict = {
@@ -13,7 +13,17 @@ class MessageType(Enum):
     ACKNOWLEDGEMENT = 45
     GET_COLOR = 101
     SET_COLOR = 102
+    SET_WAVEFORM = 103
     LIGHT_STATE = 107
+    SET_WAVEFORM_OPTIONAL = 119
+
+
+class Waveform(Enum):
+    SAW = 0
+    SINE = 1
+    HALF_SINE = 2
+    TRIANGLE = 3
+    PULSE = 4
 
 
 class MessageEncoder:
@@ -63,6 +73,9 @@ class MessageEncoder:
         self._packed_message = None
         self.reserved: int = 0  # 16 bits/uint16, all zero
 
+        # monotonic time of the MIDI event that caused this message, for latency tracing
+        self.timestamp: float | None = None
+
     @property
     def packed_message(self):
         if self._packed_message is None:
@@ -172,6 +185,61 @@ class MessageEncoder:
         return s
 
 
+# Precompiled layout for one (message type, flags) combination: constant header fields are computed once,
+# so packing a message is a single struct.pack_into that fills in size, target, sequence and payload.
+class PacketTemplate:
+    HEADER_FORMAT: str = "<HHLQ6xBB8xHH"
+    __templates: dict = {}
+
+    @staticmethod
+    def get(
+            msg_type: MessageType,
+            payload_format: str = "",
+            tagged: bool = True,
+            ack_required: bool = False,
+            res_required: bool = False,
+            source_id: int = MessageEncoder.SOURCE_INDEX
+    ) -> 'PacketTemplate':
+        key = (msg_type, payload_format, tagged, ack_required, res_required, source_id)
+        template = PacketTemplate.__templates.get(key)
+        if template is None:
+            template = PacketTemplate(*key)
+            PacketTemplate.__templates[key] = template
+        return template
+
+    def __init__(
+            self,
+            msg_type: MessageType,
+            payload_format: str = "",
+            tagged: bool = True,
+            ack_required: bool = False,
+            res_required: bool = False,
+            source_id: int = MessageEncoder.SOURCE_INDEX
+    ):
+        self.struct = struct.Struct(PacketTemplate.HEADER_FORMAT + payload_format)
+        self.size: int = self.struct.size
+        self.flags: int = ((1 if tagged else 0) << 13) | (1 << 12) | 1024  # origin 0, addressable, protocol 1024
+        self.source_id: int = source_id
+        self.ack_required: int = 1 if ack_required else 0
+        self.res_required: int = 1 if res_required else 0
+        self.response_flags: int = (self.ack_required << 1) | self.res_required
+        self.message_type: MessageType = msg_type
+        self.sequence: int = -1
+        self.buffer = bytearray(self.size)
+
+    # the returned buffer is reused by the next pack() on this template, so send it before packing again
+    def pack(self, target: int = 0, *payload, sequence: int = None) -> bytearray:
+        self.sequence = MessageEncoder.get_sequence() if sequence is None else sequence
+        self.struct.pack_into(
+            self.buffer, 0,
+            self.size, self.flags, self.source_id,
+            target, self.response_flags, self.sequence,
+            self.message_type.value, 0,
+            *payload
+        )
+        return self.buffer
+
+
 # reverses bytes for little endian, then converts to int
 def convert_mac_to_int(addr) -> int:
     reverse_bytes_str = addr.split(":")
@@ -1,13 +1,30 @@
-import bitstring
+import struct
 
-from message_encoder import MessageEncoder, MessageType
+from message_encoder import MessageEncoder, MessageType, PacketTemplate, Waveform
 
 
 class MessageMaker:
     @staticmethod
-    def reversed_bytes(bs) -> bytes:
-        # for little endian
-        return bytes(reversed(bs.bytes))
+    def hsbk(hue: float, saturation: float, brightness: float, kelvin: int) -> tuple[int, int, int, int]:
+        return (
+            int(hue % 360 / 360 * MessageEncoder.MAX_UINT16),
+            int(max(0.0, min(1.0, saturation)) * MessageEncoder.MAX_UINT16),
+            int(max(0.0, min(1.0, brightness)) * MessageEncoder.MAX_UINT16),
+            max(1500, min(9000, kelvin))
+        )
+
+    # SetWaveform when every component is given, otherwise SetWaveformOptional for the given components only
+    @staticmethod
+    def waveform(
+            hue: float = None,
+            saturation: float = None,
+            brightness: float = None,
+            kelvin: int = None,
+            **options
+    ) -> 'MessageMaker.SetWaveform':
+        if None in (hue, saturation, brightness, kelvin):
+            return MessageMaker.SetWaveformOptional(hue, saturation, brightness, kelvin, **options)
+        return MessageMaker.SetWaveform(hue, saturation, brightness, kelvin, **options)
 
     class GetService(MessageEncoder):  # 2
         def __init__(self):
@@ -24,8 +41,7 @@ class MessageMaker:
 
         def get_payload(self):
             self.payload_fields.append(("Power", self.power_level))
-            payload = MessageMaker.reversed_bytes(bitstring.pack("uint:16", self.power_level))
-            return payload
+            return struct.pack("<H", self.power_level)
 
     class GetLabel(MessageEncoder):  # 23
         def __init__(self):
@@ -36,6 +52,8 @@ class MessageMaker:
             super().__init__(msg_type=MessageType.GET_COLOR, res_required=True)
 
     class SetColor(MessageEncoder):  # 102
+        PAYLOAD_FORMAT: str = "<xHHHHI"  # reserved 8, hue, saturation, brightness, kelvin, duration
+
         def __init__(
                 self,
                 hue: float = 0,
@@ -52,12 +70,114 @@ class MessageMaker:
             super().__init__(msg_type=MessageType.SET_COLOR, ack_required=True)
 
         def get_payload(self):
-            hue = int(self.hue / 360 * MessageEncoder.MAX_UINT16)
-            saturation = int(self.saturation * MessageEncoder.MAX_UINT16)
-            brightness = int(self.brightness * MessageEncoder.MAX_UINT16)
-
-            reserved_8 = MessageMaker.reversed_bytes(bitstring.pack("uint:8", 0))
-            color_fields = [hue, saturation, brightness, self.kelvin]
-            color = b"".join(MessageMaker.reversed_bytes(bitstring.pack("uint:16", field)) for field in color_fields)
-            duration = MessageMaker.reversed_bytes(bitstring.pack("uint:32", self.duration))
-            return reserved_8 + color + duration
+            color = MessageMaker.hsbk(self.hue, self.saturation, self.brightness, self.kelvin)
+            return struct.pack(MessageMaker.SetColor.PAYLOAD_FORMAT, *color, self.duration)
+
+    # The bulb animates from its current color towards the given color and back, for the given number of cycles.
+    # Transient waveforms return to the original color when done, otherwise the bulb keeps the given color.
+    class SetWaveform(MessageEncoder):  # 103
+        # reserved 8, transient, hue, saturation, brightness, kelvin, period, cycles, skew ratio, waveform
+        PAYLOAD_FORMAT: str = "<xBHHHHIfhB"
+
+        def __init__(
+                self,
+                hue: float = 0,
+                saturation: float = 1,
+                brightness: float = 1,
+                kelvin: int = 4000,
+                period: int = 1000,
+                cycles: float = 1,
+                skew_ratio: float = 0.5,
+                waveform: Waveform = Waveform.SINE,
+                transient: bool = True,
+                msg_type: MessageType = MessageType.SET_WAVEFORM
+        ):
+            self.hue = hue % 360
+            self.saturation: float = max(0.0, min(1.0, saturation))
+            self.brightness: float = max(0.0, min(1.0, brightness))
+            self.kelvin: int = max(1500, min(9000, kelvin))
+            self.period: int = period  # milliseconds per cycle
+            self.cycles: float = cycles
+            self.skew_ratio: float = max(0.0, min(1.0, skew_ratio))  # share of the period spent on the given color
+            self.waveform: Waveform = waveform
+            self.transient: bool = transient
+            super().__init__(msg_type=msg_type, ack_required=True)
+
+        def get_waveform_payload(self) -> tuple:
+            return (
+                1 if self.transient else 0,
+                *MessageMaker.hsbk(self.hue, self.saturation, self.brightness, self.kelvin),
+                self.period,
+                self.cycles,
+                int(self.skew_ratio * MessageEncoder.MAX_UINT16) - 32768,
+                self.waveform.value
+            )
+
+        def get_payload(self):
+            return struct.pack(MessageMaker.SetWaveform.PAYLOAD_FORMAT, *self.get_waveform_payload())
+
+    # SetWaveform that leaves the components passed as None untouched, e.g. a brightness pulse over any hue.
+    class SetWaveformOptional(SetWaveform):  # 119
+        # SetWaveform payload, then set hue, set saturation, set brightness, set kelvin
+        PAYLOAD_FORMAT: str = "<xBHHHHIfhBBBBB"
+
+        def __init__(
+                self,
+                hue: float = None,
+                saturation: float = None,
+                brightness: float = None,
+                kelvin: int = None,
+                period: int = 1000,
+                cycles: float = 1,
+                skew_ratio: float = 0.5,
+                waveform: Waveform = Waveform.SINE,
+                transient: bool = True
+        ):
+            self.set_components: tuple = tuple(
+                0 if component is None else 1 for component in (hue, saturation, brightness, kelvin)
+            )
+            super().__init__(
+                hue=0 if hue is None else hue,
+                saturation=0 if saturation is None else saturation,
+                brightness=0 if brightness is None else brightness,
+                kelvin=4000 if kelvin is None else kelvin,
+                period=period,
+                cycles=cycles,
+                skew_ratio=skew_ratio,
+                waveform=waveform,
+                transient=transient,
+                msg_type=MessageType.SET_WAVEFORM_OPTIONAL
+            )
+
+        def get_payload(self):
+            return struct.pack(
+                MessageMaker.SetWaveformOptional.PAYLOAD_FORMAT,
+                *self.get_waveform_payload(),
+                *self.set_components
+            )
+
+    # Reusable fast path for SetColor (102), packed from a cached PacketTemplate instead of a new MessageEncoder.
+    # The returned buffer is overwritten by the next pack(), so send it before packing again.
+    class SetColorPacket:
+        def __init__(self, ack_required: bool = False, tagged: bool = True):
+            self.template = PacketTemplate.get(
+                MessageType.SET_COLOR,
+                MessageMaker.SetColor.PAYLOAD_FORMAT[1:],
+                tagged=tagged,
+                ack_required=ack_required
+            )
+
+        @property
+        def sequence(self) -> int:
+            return self.template.sequence
+
+        def pack(
+                self,
+                hue: float = 0,
+                saturation: float = 1,
+                brightness: float = 1,
+                kelvin: int = 4000,
+                duration: int = 100,
+                target: int = 0
+        ) -> bytearray:
+            return self.template.pack(target, *MessageMaker.hsbk(hue, saturation, brightness, kelvin), duration)
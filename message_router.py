@@ -1,65 +1,180 @@
 import socket
 import asyncio
+from collections import deque
 
-from message_encoder import MessageEncoder
-from message_decoder import MessageDecoder
+from event_journal import EventJournal, JournalRecordType
+from latency_tracer import LatencyTracer
+from message_encoder import MessageEncoder, MessageType
+from message_decoder import MessageDecoder, DecodedMessage, IncompleteHeader
 from message_maker import MessageMaker
 
 
+class ResponseTimeout(Exception):
+    def __init__(self, address: tuple, sequence: int):
+        super().__init__(f"No response from {address[0]} to sequence {sequence}")
+        self.address = address
+        self.sequence = sequence
+
+
+class RouterProtocol(asyncio.DatagramProtocol):
+    def __init__(self, router):
+        self.router = router
+
+    def datagram_received(self, data: bytes, address: tuple) -> None:
+        self.router.dispatch(data, address)
+
+    def connection_lost(self, exc) -> None:
+        self.router.on_connection_lost()
+
+
 class MessageRouter:
     HOST_IP = socket.gethostbyname(socket.gethostname())
     PORT = 56700
     HOST_ADDRESS = (HOST_IP, PORT)
+    RESPONSE_TIMEOUT: float = 1
+    UNMATCHED_CAPACITY: int = 256
+    STATE_TYPES: set = {MessageType.STATE_POWER.value, MessageType.STATE_LABEL.value, MessageType.LIGHT_STATE.value}
 
-    def __init__(self):
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.bind(MessageRouter.HOST_ADDRESS)
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    def __init__(self, tracer: LatencyTracer = None, journal: EventJournal = None):
+        self.socket = self.create_socket()
+        self.transport: asyncio.DatagramTransport | None = None
+        self.closed: asyncio.Future | None = None
 
         self.decoder = MessageDecoder()
+        self.tracer: LatencyTracer = LatencyTracer(enabled=False) if tracer is None else tracer
+        self.journal: EventJournal = EventJournal() if journal is None else journal
         self.lock = asyncio.Lock()
         self.is_receiving: bool = False
-        self.responses: dict = {}
+        self.pending: dict[tuple, asyncio.Future] = {}  # (source, address, sequence) -> future
+        self.unmatched: deque = deque(maxlen=MessageRouter.UNMATCHED_CAPACITY)  # (address, message) nobody awaited
+        self.discoveries: dict[int, dict] = {}  # sequence of a running discovery -> {address: label and target}
+        self.devices: dict = {}  # address -> device, whose state is updated from every State packet it sends
+
+    @staticmethod
+    def create_socket() -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(MessageRouter.HOST_ADDRESS)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        return sock
 
-    async def discover_devices(self, discovery_timeout: float = 2) -> dict:
+    async def open_transport(self) -> None:
+        if self.transport is not None:
+            return
         async with self.lock:
-            self.socket.settimeout(discovery_timeout)
-            self.socket.sendto(MessageMaker.GetLabel().generate_packed_message(), ('<broadcast>', MessageRouter.PORT))
+            if self.transport is not None:
+                return
+            if self.socket.fileno() == -1:
+                self.socket = self.create_socket()
+            loop = asyncio.get_running_loop()
+            self.transport, _ = await loop.create_datagram_endpoint(lambda: RouterProtocol(self), sock=self.socket)
+            self.closed = loop.create_future()
 
-            devices_info = {}
-            while True:
-                try:
-                    response, address = self.socket.recvfrom(1024)
-                    label = self.decoder.decode(response)['payload']
-                    devices_info[address] = label
-                except socket.timeout:
-                    break
+    def close_transport(self) -> None:
+        if self.transport is not None:
+            self.transport.close()
 
-            self.socket.settimeout(None)
-            return devices_info
+    def on_connection_lost(self) -> None:
+        self.transport = None
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        if self.closed is not None and not self.closed.done():
+            self.closed.set_result(None)
+
+    async def discover_devices(
+            self,
+            discovery_timeout: float = 2,
+            addresses: list[tuple] = None
+    ) -> dict:
+        await self.open_transport()
+        encoder = MessageMaker.GetLabel()
+        packet = encoder.generate_packed_message()
+        self.discoveries[encoder.sequence] = {}
+        for address in [('<broadcast>', MessageRouter.PORT)] if addresses is None else addresses:
+            self.transport.sendto(packet, address)
+            self.journal.record_packet(JournalRecordType.PACKET_SENT, packet, address)
+        try:
+            await asyncio.sleep(discovery_timeout)
+        finally:
+            responses = self.discoveries.pop(encoder.sequence)
+        return responses
 
     async def set_receiving(self, receiving: bool = True):
         async with self.lock:
             self.is_receiving = receiving
         if not receiving:
-            self.socket.sendto(b'', MessageRouter.HOST_ADDRESS)
+            self.close_transport()
 
     async def start_receiving(self) -> None:
-        while self.is_receiving:
-            asyncio.create_task(self.store_response(*await asyncio.to_thread(self.socket.recvfrom, 1024)))
+        await self.open_transport()
+        await self.closed
 
-    async def store_response(self, response, address):
-        async with self.lock:
-            self.responses[address] = response
+    def dispatch(self, response: bytes, address: tuple) -> None:
+        self.journal.record_packet(JournalRecordType.PACKET_RECEIVED, response, address)
+        try:
+            message = self.decoder.decode(response)
+        except IncompleteHeader:
+            return
 
-    async def send_and_await_response(self, encoder: MessageEncoder, device) -> dict:
-        async with self.lock:
-            self.socket.sendto(encoder.generate_packed_message(), device.address)
-        if encoder.res_required + encoder.ack_required > 0:
-            while device.address not in self.responses:
-                await asyncio.sleep(0)
-            async with self.lock:
-                response = self.responses.pop(device.address)
-                return self.decoder.decode(response)
+        device = self.devices.get(address)
+        if device is not None and message.pkt_type in MessageRouter.STATE_TYPES:
+            device.update_state(message.payload)
+
+        future = self.pending.pop((message.source, address, message.sequence), None)
+        if future is not None and not future.done():
+            future.set_result(message)
+        elif message.sequence in self.discoveries and message.pkt_type == MessageType.STATE_LABEL.value:
+            self.discoveries[message.sequence][address] = {**message.payload, 'target': message.target}
         else:
+            self.unmatched.append((address, message))
+
+    def register_device(self, device) -> None:
+        self.devices[device.address] = device
+
+    def unregister_device(self, device) -> None:
+        if self.devices.get(device.address) is device:
+            del self.devices[device.address]
+
+    # fire and forget, the transport must already be open
+    def send(self, packet: bytes, address: tuple, timestamp: float = None) -> None:
+        self.transport.sendto(packet, address)
+        self.tracer.record('send', timestamp)
+        self.journal.record_packet(JournalRecordType.PACKET_SENT, packet, address)
+
+    def expect_response(self, address: tuple, sequence: int, source: int = MessageEncoder.SOURCE_INDEX) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.pending[(source, address, sequence)] = future
+        return future
+
+    async def wait_for_response(
+            self,
+            future: asyncio.Future,
+            address: tuple,
+            sequence: int,
+            source: int = MessageEncoder.SOURCE_INDEX,
+            timeout: float = RESPONSE_TIMEOUT
+    ) -> DecodedMessage:
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.pending.pop((source, address, sequence), None)
+            raise ResponseTimeout(address, sequence)
+
+    async def send_and_await_response(
+            self,
+            encoder: MessageEncoder,
+            device,
+            timeout: float = RESPONSE_TIMEOUT
+    ) -> DecodedMessage | dict:
+        await self.open_transport()
+        packet = encoder.generate_packed_message()
+        self.tracer.record('encode', encoder.timestamp)
+        if encoder.res_required + encoder.ack_required == 0:
+            self.send(packet, device.address, encoder.timestamp)
             return {}
+
+        future = self.expect_response(device.address, encoder.sequence, encoder.source_id)
+        self.send(packet, device.address, encoder.timestamp)
+        message = await self.wait_for_response(future, device.address, encoder.sequence, encoder.source_id, timeout)
+        self.tracer.record('ack', encoder.timestamp)
+        return message
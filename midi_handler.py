@@ -1,30 +1,54 @@
 import asyncio
+import time
 from enum import Enum
+from typing import NamedTuple
 
 import rtmidi
 from rtmidi.midiutil import open_midiinput
 
 from globals import Globals
-from notes_to_hue_converter import MidiNote
+from notes_to_hue_converter import MidiNote, NotesToHueConverter
+
+
+class MidiEvent(NamedTuple):
+    message: list[int]
+    delta_time: float  # seconds since the previous message, as measured by rtmidi
+    midi_time: float  # seconds since the port was opened, the sum of all delta times
+    received_at: float  # time.monotonic() when the rtmidi callback fired
 
 
 class MidiHandler:
+    QUEUE_SIZE: int = 1024
+
     class MidiMessageType(Enum):
         NOTE_OFF = 128
         NOTE_ON = 144
+        POLYPHONIC_AFTERTOUCH = 160
         MODE_CHANGE = 176
         CHANNEL_AFTERTOUCH = 208
+        PITCH_BEND = 224
 
     class CCNumber(Enum):
         SUSTAIN = 64
 
-    def __init__(self):
+    # One handler per MIDI input port. Routes map a MIDI channel (0-15) to the converter it drives, with None
+    # for every other channel, and each converter has its own queue and consumer, so a dense part on one
+    # channel never delays another. By default only the first channel drives the global converter.
+    def __init__(self, midi_input_index: int = 0, routes: dict[int | None, NotesToHueConverter] = None):
         self.lock = asyncio.Lock()
+        self.midi_input_index: int = midi_input_index
+        self.routes: dict[int | None, NotesToHueConverter] = {0: Globals.converter} if routes is None else routes
         self.midi_in = None
         self.is_receiving = False
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.queues: dict[NotesToHueConverter, asyncio.Queue] = {}
+        self.midi_time: float = 0
+        self.dropped_messages: int = 0
+        self.ignored_messages: int = 0  # system messages and channels without a route
 
-    async def open_midi_input(self, midi_input_index: int = 0) -> bool:
-        print('Attempting to open MIDI input...')
+    async def open_midi_input(self, midi_input_index: int = None) -> bool:
+        midi_input_index = self.midi_input_index if midi_input_index is None else midi_input_index
+        print(f'Attempting to open MIDI input {midi_input_index}...')
         async with self.lock:
             try:
                 self.midi_in = open_midiinput(midi_input_index)[0]
@@ -52,36 +76,99 @@ class MidiHandler:
     async def start_receiving(self) -> None:
         if not await self.open_midi_input():
             return
+        self.loop = asyncio.get_running_loop()
+        self.queues = {converter: asyncio.Queue(MidiHandler.QUEUE_SIZE) for converter in self.routes.values()}
+        self.midi_time = 0
+        self.midi_in.set_callback(self.on_midi_message)
         print("Entering main loop. Press Control-C to exit.")
+        await asyncio.gather(*[self.consume(queue, converter) for converter, queue in self.queues.items()])
+
+    async def consume(self, queue: asyncio.Queue, converter: NotesToHueConverter) -> None:
         while self.is_receiving:
-            message = self.midi_in.get_message()
-            if message is not None:
-                asyncio.create_task(self.process_message(message[0]))
-            await asyncio.sleep(0)
+            event = await queue.get()
+            if event is not None:
+                await self.process_message(event.message, event.received_at, converter)
+
+    # the status byte carries the message type in the high nibble and the channel in the low nibble
+    def converter_for(self, status: int) -> NotesToHueConverter | None:
+        if status >= 0xF0:
+            return None
+        converter = self.routes.get(status & 0x0F)
+        return self.routes.get(None) if converter is None else converter
+
+    # called on the rtmidi thread
+    def on_midi_message(self, event: tuple, data=None) -> None:
+        message, delta_time = event
+        self.midi_time += delta_time
+        converter = self.converter_for(message[0])
+        if converter is None:
+            self.ignored_messages += 1
+            return
+        midi_event = MidiEvent(message, delta_time, self.midi_time, time.monotonic())
+        self.loop.call_soon_threadsafe(self.enqueue_event, self.queues[converter], midi_event)
 
-    async def process_message(self, message: list[int]) -> None:
-        message_type = message[0]
+    def enqueue_event(self, queue: asyncio.Queue, event: MidiEvent | None) -> None:
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped_messages += 1
+
+    async def process_message(
+            self,
+            message: list[int],
+            timestamp: float = None,
+            converter: NotesToHueConverter = None
+    ) -> None:
+        converter = self.converter_for(message[0]) if converter is None else converter
+        if converter is None:
+            self.ignored_messages += 1
+            return
+        if timestamp is None:
+            timestamp = time.monotonic()
+        else:
+            Globals.tracer.record('midi_queue', timestamp)
+        Globals.journal.record_midi(message, timestamp, self.midi_input_index)
+        previous_hue = converter.current_hue
+
+        message_type = message[0] & 0xF0
         match message_type:
             case MidiHandler.MidiMessageType.NOTE_ON.value:
                 _, pitch, velocity = message
                 if velocity == 0:
-                    await Globals.converter.remove_note(pitch=message[1])
+                    await converter.remove_note(pitch=message[1], timestamp=timestamp)
                 else:
-                    await Globals.converter.add_note(MidiNote(pitch=pitch, velocity=velocity))
+                    await converter.add_note(MidiNote(pitch=pitch, velocity=velocity), timestamp=timestamp)
 
             case MidiHandler.MidiMessageType.NOTE_OFF.value:
-                await Globals.converter.remove_note(pitch=message[1])
+                await converter.remove_note(pitch=message[1], timestamp=timestamp)
 
             case MidiHandler.MidiMessageType.MODE_CHANGE.value:
                 _, cc, value = message
                 match cc:
                     case MidiHandler.CCNumber.SUSTAIN.value:
-                        await Globals.converter.set_sustain(value=value)
+                        await converter.set_sustain(value=value, timestamp=timestamp)
+                    case _:
+                        converter.controllers.set_cc(cc, value, timestamp)
 
+            # controllers only keep their latest value, the next outgoing frame picks it up
             case MidiHandler.MidiMessageType.CHANNEL_AFTERTOUCH.value:
-                pass
+                converter.controllers.set('aftertouch', message[1], timestamp)
+
+            case MidiHandler.MidiMessageType.POLYPHONIC_AFTERTOUCH.value:
+                converter.controllers.set('aftertouch', message[2], timestamp)
+
+            case MidiHandler.MidiMessageType.PITCH_BEND.value:
+                _, lsb, msb = message
+                converter.controllers.set_pitch_bend(lsb, msb, timestamp)
+
+        if converter.current_hue != previous_hue:
+            Globals.journal.record_hue(converter.current_hue, timestamp)
+        Globals.tracer.record('convert', timestamp)
 
     async def stop_receiving(self) -> None:
         async with self.lock:
             self.is_receiving = False
+            self.midi_in.cancel_callback()
             await self.close_midi_input()
+        for queue in self.queues.values():
+            self.enqueue_event(queue, None)  # wakes the consumers so they can exit
@@ -1,8 +1,14 @@
 import asyncio
-import copy
+from array import array
+
+from controller_state import ControllerState
+from latest_value import LatestValue
+from onset_estimator import OnsetEstimator
 
 
 class MidiNote:
+    __slots__ = ('pitch', 'velocity', 'hue', 'is_pedalled')
+
     note_to_hue: dict = {
         0: 0,       # C
         1: 210,     # C#
@@ -33,11 +39,38 @@ class MidiNote:
 
 
 class NotesToHueConverter:
-    def __init__(self, notes: list[MidiNote] = None):
+    PITCH_COUNT: int = 128
+    SUSTAIN_THRESHOLD: int = 32
+
+    # notes live in a table indexed by MIDI pitch, with one bit per pitch in the active and pedalled masks
+    # every held pitch keeps the sequence number of its onset, notes are solved in the order they were added
+    # with a hue_table, the hue is looked up by the set of held pitch classes instead of solved on every event
+    def __init__(
+            self,
+            notes: list[MidiNote] = None,
+            hue_table: 'PitchClassHueTable' = None,
+            velocity_correction: bool = True
+    ):
         self.lock: asyncio.Lock = asyncio.Lock()
-        self.notes: list[MidiNote] = [] if notes is None else notes
+        self.velocities: array = array('B', bytes(NotesToHueConverter.PITCH_COUNT))
+        self.hues: array = array('H', [MidiNote.note_to_hue[p % 12] for p in range(NotesToHueConverter.PITCH_COUNT)])
+        self.active: int = 0
+        self.pedalled: int = 0
+        self.onset_sequence: list[int] = [0] * NotesToHueConverter.PITCH_COUNT
+        self.next_onset: int = 0
+        # held pitches folded to pitch classes, kept up to date on every event for the hue table lookup
+        self.class_counts: array = array('B', bytes(12))
+        self.class_velocities: array = array('H', bytes(24))
+        self.pitch_classes: int = 0
         self.current_hue: float = 0
+        self.hue_channel: LatestValue = LatestValue(self.current_hue)  # published on every change of current_hue
         self.sustain: int = 0
+        self.onsets: OnsetEstimator = OnsetEstimator()
+        self.controllers: ControllerState = ControllerState()  # velocity, aftertouch, pitch bend and CCs
+        self.hue_table: PitchClassHueTable | None = hue_table
+        self.velocity_correction: bool = velocity_correction
+        for note in [] if notes is None else notes:
+            self.hold(note.pitch, note.velocity)
 
     def __str__(self):
         s = 'Notes:\n'
@@ -45,74 +78,251 @@ class NotesToHueConverter:
             s += f'{note}\n'
         return s
 
+    @property
+    def pitches(self) -> list[int]:
+        pitches = []
+        mask = self.active
+        while mask:
+            lowest_bit = mask & -mask
+            pitches.append(lowest_bit.bit_length() - 1)
+            mask ^= lowest_bit
+        return pitches
+
+    # held pitches in the order they were added, a pitch struck again while held keeps its place
+    @property
+    def ordered_pitches(self) -> list[int]:
+        return sorted(self.pitches, key=self.onset_sequence.__getitem__)
+
+    @property
+    def notes(self) -> list[MidiNote]:
+        notes = []
+        for pitch in self.ordered_pitches:
+            note = MidiNote(pitch=pitch, velocity=self.velocities[pitch])
+            note.is_pedalled = (self.pedalled >> pitch) & 1 == 1
+            notes.append(note)
+        return notes
+
     async def async_get_current_hue(self):
         async with self.lock:
             return self.current_hue
 
-    async def add_note(self, note: MidiNote) -> None:
+    def hold(self, pitch: int, velocity: int) -> None:
+        bit = 1 << pitch
+        pitch_class = pitch % 12
+        if self.active & bit:
+            self.class_velocities[pitch_class] -= self.velocities[pitch]
+        else:
+            self.onset_sequence[pitch] = self.next_onset
+            self.next_onset += 1
+            self.class_counts[pitch_class] += 1
+            self.pitch_classes |= 1 << pitch_class
+        self.class_velocities[pitch_class] += velocity
+        self.velocities[pitch] = velocity
+        self.active |= bit
+        self.pedalled &= ~bit
+
+    def release(self, mask: int) -> None:
+        mask &= self.active
+        self.active &= ~mask
+        while mask:
+            lowest_bit = mask & -mask
+            pitch = lowest_bit.bit_length() - 1
+            pitch_class = pitch % 12
+            self.class_velocities[pitch_class] -= self.velocities[pitch]
+            self.class_counts[pitch_class] -= 1
+            if self.class_counts[pitch_class] == 0:
+                self.pitch_classes &= ~(1 << pitch_class)
+            mask ^= lowest_bit
+
+    async def add_note(self, note: MidiNote, timestamp: float = None) -> None:
         async with self.lock:
-            is_note_in_converter = False
-            for n in self.notes:
-                if n.pitch == note.pitch:
-                    n.velocity = note.velocity
-                    n.is_pedalled = False
-                    is_note_in_converter = True
-
-            if not is_note_in_converter:
-                self.notes.append(note)
-        await self.convert()
-
-    async def remove_note(self, pitch: int) -> None:
+            self.hold(note.pitch, note.velocity)
+            self.onsets.add_onset(timestamp)
+            self.controllers.set('velocity', note.velocity, timestamp)
+        await self.convert(timestamp)
+
+    # SetColor duration in milliseconds that lasts until the next expected note
+    @property
+    def transition_duration(self) -> int:
+        return self.onsets.transition_duration
+
+    async def remove_note(self, pitch: int, timestamp: float = None) -> None:
         async with self.lock:
-            for n in self.notes:
-                if n.pitch == pitch:
-                    if self.sustain < 32:
-                        self.notes.remove(n)
-                    else:
-                        n.is_pedalled = True
-        await self.convert()
-
-    async def set_sustain(self, value: int = 0) -> None:
+            bit = 1 << pitch
+            if self.sustain < NotesToHueConverter.SUSTAIN_THRESHOLD:
+                self.release(bit)
+            else:
+                self.pedalled |= self.active & bit
+        await self.convert(timestamp)
+
+    async def set_sustain(self, value: int = 0, timestamp: float = None) -> None:
         async with self.lock:
             self.sustain = value
-            print(self.sustain)
-            to_remove = []
-            if self.sustain < 32:
-                to_remove = [n for n in self.notes if n.is_pedalled]
-        for n in to_remove:
-            await self.remove_note(n.pitch)
-
-    async def convert(self) -> float:
-        async with self.lock:
-            if len(self.notes) == 0:
-                self.current_hue = -1
-                return self.current_hue
-            converter_copy = copy.deepcopy(self)
-            converter_copy.lock = asyncio.Lock()
-        converter_copy.notes.sort(key=lambda n: n.hue)
-        best_hue = await converter_copy.weighted_average()
-        best_distance = await converter_copy.distance_from_hue(best_hue)
-        for note in converter_copy.notes:
-            note.hue += 360
-            new_hue = await converter_copy.weighted_average()
-            new_distance = await converter_copy.distance_from_hue(new_hue)
-            if new_distance < best_distance:
-                best_hue = new_hue
-                best_distance = new_distance
+            released = 0
+            if self.sustain < NotesToHueConverter.SUSTAIN_THRESHOLD:
+                released, self.pedalled = self.pedalled, 0
+                self.release(released)
+        if released:
+            await self.convert(timestamp)
+
+    async def convert(self, timestamp: float = None) -> float:
         async with self.lock:
-            self.current_hue = best_hue % 360
+            if self.hue_table is not None:
+                new_hue = self.table_hue()
+            else:
+                pitches = self.ordered_pitches
+                hues = [self.hues[pitch] for pitch in pitches]
+                velocities = [self.velocities[pitch] for pitch in pitches]
+                new_hue = NotesToHueConverter.solve_weighted_hues(hues, velocities)
+            if new_hue != self.current_hue:
+                self.current_hue = new_hue
+                self.hue_channel.publish(new_hue, timestamp)
             return self.current_hue
 
-    async def weighted_average(self) -> float:
-        async with self.lock:
-            if len(self.notes) == 0:
-                return 0
-            numerator = sum([note.hue * note.velocity for note in self.notes])
-            denominator = sum([note.velocity for note in self.notes])
-            return numerator / denominator
+    def table_hue(self) -> float:
+        mask = self.pitch_classes
+        hue = self.hue_table.hues[mask]
+        if not self.velocity_correction or hue == -1:
+            return hue
+        return self.hue_table.correct_for_velocities(mask, self.class_velocities)
 
-    async def distance_from_hue(self, hue: float) -> float:
-        async with self.lock:
-            if len(self.notes) == 0:
-                return 0
-            return sum([abs(note.velocity * (hue - note.hue)) for note in self.notes])
+    # Minimizes the velocity weighted distance between the notes and their weighted average hue over every way of
+    # unrolling the color wheel: sorted by hue, the first k notes are moved up by 360 degrees for each k.
+    # Prefix sums over the notes doubled by 360 make each candidate O(1), and since both the average and its
+    # position among the hues only grow with k, a single moving split index replaces a search per candidate.
+    # Distances are compared scaled by the total velocity, which keeps them exact for integer hues and velocities.
+    @staticmethod
+    def solve_hue(notes: list[MidiNote]) -> float:
+        return NotesToHueConverter.solve_weighted_hues([note.hue for note in notes], [note.velocity for note in notes])
+
+    @staticmethod
+    def solve_weighted_hues(note_hues: list[int], note_velocities: list[int]) -> float:
+        n = len(note_hues)
+        if n == 0:
+            return -1
+
+        order = sorted(range(n), key=lambda i: note_hues[i])
+        hues = [note_hues[i] for i in order] + [note_hues[i] + 360 for i in order]
+        velocities = [note_velocities[i] for i in order] * 2
+        prefix_v = [0] * (2 * n + 1)
+        prefix_vh = [0] * (2 * n + 1)
+        for i in range(2 * n):
+            prefix_v[i + 1] = prefix_v[i] + velocities[i]
+            prefix_vh[i + 1] = prefix_vh[i] + velocities[i] * hues[i]
+
+        total_v = prefix_v[n]
+        if total_v == 0:
+            return 0
+        best_rotations = []
+        best_distance = None
+        split = 0
+        for k in range(n + 1):
+            end = k + n
+            numerator = prefix_vh[end] - prefix_vh[k]
+            split = max(split, k)
+            while split < end and total_v * hues[split] <= numerator:
+                split += 1
+            below_v = prefix_v[split] - prefix_v[k]
+            below_vh = prefix_vh[split] - prefix_vh[k]
+            above_v = prefix_v[end] - prefix_v[split]
+            above_vh = prefix_vh[end] - prefix_vh[split]
+            distance = numerator * (below_v - above_v) + total_v * (above_vh - below_vh)
+            if best_distance is None or distance < best_distance:
+                best_rotations = [k]
+                best_distance = distance
+            elif distance == best_distance:
+                best_rotations.append(k)
+
+        # exact ties are broken the way the float based search always broke them
+        best_k = best_rotations[0]
+        if len(best_rotations) > 1:
+            def float_distance(rotations: int) -> float:
+                hue = (prefix_vh[rotations + n] - prefix_vh[rotations]) / total_v
+                return sum([abs(velocities[i] * (hue - hues[i + n if i < rotations else i])) for i in range(n)])
+
+            best_float_distance = float_distance(best_k)
+            for k in best_rotations[1:]:
+                new_distance = float_distance(k)
+                if new_distance < best_float_distance:
+                    best_k = k
+                    best_float_distance = new_distance
+        return ((prefix_vh[best_k + n] - prefix_vh[best_k]) / total_v) % 360
+
+
+# Hue for each of the 4096 sets of pitch classes, indexed by a 12 bit mask with bit p set for pitch class p.
+# Entries are the equal weight solution over the note_to_hue wheel, optionally replaced for chord qualities,
+# so coloring a chord is one array index however many notes are held.
+class PitchClassHueTable:
+    SIZE: int = 4096
+    ALL_PITCH_CLASSES: int = 0xFFF
+
+    # chord shapes as pitch class intervals from the root, for quality overrides
+    CHORD_QUALITIES: dict = {
+        'major': (0, 4, 7),
+        'minor': (0, 3, 7),
+        'diminished': (0, 3, 6),
+        'augmented': (0, 4, 8),
+        'sus2': (0, 2, 7),
+        'sus4': (0, 5, 7),
+        'dominant7': (0, 4, 7, 10),
+        'major7': (0, 4, 7, 11),
+        'minor7': (0, 3, 7, 10)
+    }
+
+    def __init__(self, wheel: dict = None, quality_overrides: dict = None, hues: array = None):
+        self.wheel: dict = MidiNote.note_to_hue if wheel is None else wheel
+        if hues is None:
+            hues = array('d', [
+                NotesToHueConverter.solve_weighted_hues(*self.unweighted_hues(mask))
+                for mask in range(PitchClassHueTable.SIZE)
+            ])
+        self.hues: array = hues
+        for quality, hue_offset in ({} if quality_overrides is None else quality_overrides).items():
+            self.override_quality(quality, hue_offset)
+
+    def unweighted_hues(self, mask: int) -> tuple[list[int], list[int]]:
+        hues = [self.wheel[pitch_class] for pitch_class in range(12) if (mask >> pitch_class) & 1]
+        return hues, [1] * len(hues)
+
+    @staticmethod
+    def mask_for(pitch_classes) -> int:
+        mask = 0
+        for pitch_class in pitch_classes:
+            mask |= 1 << (pitch_class % 12)
+        return mask
+
+    def set_hue(self, pitch_classes, hue: float) -> None:
+        self.hues[PitchClassHueTable.mask_for(pitch_classes)] = hue % 360
+
+    # Colors every transposition of a chord shape by its root's hue plus hue_offset, e.g. {'major': 0}
+    # shows major triads in the color of their root instead of the average of their notes.
+    def override_quality(self, quality: str | tuple, hue_offset: float = 0) -> None:
+        intervals = PitchClassHueTable.CHORD_QUALITIES[quality] if isinstance(quality, str) else quality
+        for root in range(12):
+            self.set_hue([root + interval for interval in intervals], self.wheel[root] + hue_offset)
+
+    # Unequal velocities can move the weighted solution onto another unrolling of the wheel than the equal weight
+    # entry, so no shift of the entry is bounded. They are solved exactly over the held pitch classes, each
+    # weighted by its summed velocity, and an overridden entry keeps its offset from the equal weight solution.
+    def correct_for_velocities(self, mask: int, class_velocities: list[int]) -> float:
+        hue = self.hues[mask]
+        hues, ones = self.unweighted_hues(mask)
+        velocities = [class_velocities[pitch_class] for pitch_class in range(12) if (mask >> pitch_class) & 1]
+        if min(velocities) == max(velocities):
+            return hue
+        weighted = NotesToHueConverter.solve_weighted_hues(hues, velocities)
+        unweighted = NotesToHueConverter.solve_weighted_hues(hues, ones)
+        if hue == unweighted:
+            return weighted
+        return (weighted + hue - unweighted) % 360
+
+    def save(self, path: str) -> None:
+        with open(path, 'wb') as table_file:
+            self.hues.tofile(table_file)
+
+    @staticmethod
+    def load(path: str, wheel: dict = None) -> 'PitchClassHueTable':
+        hues = array('d')
+        with open(path, 'rb') as table_file:
+            hues.fromfile(table_file, PitchClassHueTable.SIZE)
+        return PitchClassHueTable(wheel, hues=hues)
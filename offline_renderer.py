@@ -0,0 +1,314 @@
+import struct
+import sys
+import time
+
+import numpy as np
+
+from notes_to_hue_converter import MidiNote, NotesToHueConverter
+
+
+class MidiFileError(Exception):
+    pass
+
+
+# Minimal Standard MIDI File reader: merges the channel messages of every track into one timeline in seconds,
+# following the tempo map. Meta and system exclusive events other than tempo changes are skipped.
+class MidiFileReader:
+    DEFAULT_TEMPO: int = 500000  # microseconds per quarter note, 120 bpm
+
+    @staticmethod
+    def read_variable_length(data: bytes, pos: int) -> tuple[int, int]:
+        value = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            value = (value << 7) | (byte & 0x7F)
+            if byte & 0x80 == 0:
+                return value, pos
+
+    @staticmethod
+    def read_track(data: bytes, events: list, tempos: list) -> None:
+        pos = 0
+        tick = 0
+        running_status = None
+        while pos < len(data):
+            delta, pos = MidiFileReader.read_variable_length(data, pos)
+            tick += delta
+            status = data[pos]
+            if status & 0x80:
+                pos += 1
+            elif running_status is None:
+                raise MidiFileError(f'Data byte without status at offset {pos}')
+            else:
+                status = running_status
+
+            if status == 0xFF:
+                meta_type = data[pos]
+                length, pos = MidiFileReader.read_variable_length(data, pos + 1)
+                if meta_type == 0x51:
+                    tempos.append((tick, int.from_bytes(data[pos:pos + 3], byteorder='big')))
+                elif meta_type == 0x2F:
+                    return
+                pos += length
+                running_status = None
+            elif status in (0xF0, 0xF7):
+                length, pos = MidiFileReader.read_variable_length(data, pos)
+                pos += length
+                running_status = None
+            else:
+                running_status = status
+                if status & 0xF0 in (0xC0, 0xD0):
+                    events.append((tick, status, data[pos], 0))
+                    pos += 1
+                else:
+                    events.append((tick, status, data[pos], data[pos + 1]))
+                    pos += 2
+
+    # returns parallel arrays of event times in seconds, status bytes and both data bytes
+    @staticmethod
+    def read(path: str) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        with open(path, 'rb') as midi_file:
+            data = midi_file.read()
+        if data[:4] != b'MThd':
+            raise MidiFileError(f'{path} is not a Standard MIDI File')
+        header_length = int.from_bytes(data[4:8], byteorder='big')
+        _, track_count, division = struct.unpack('>HHH', data[8:14])
+
+        events = []
+        tempos = []
+        pos = 8 + header_length
+        for _ in range(track_count):
+            chunk_type = data[pos:pos + 4]
+            length = int.from_bytes(data[pos + 4:pos + 8], byteorder='big')
+            if chunk_type == b'MTrk':
+                MidiFileReader.read_track(data[pos + 8:pos + 8 + length], events, tempos)
+            pos += 8 + length
+        events.sort(key=lambda event: event[0])  # stable, events on the same tick keep their track order
+
+        table = np.array(events, dtype=np.int64).reshape(-1, 4)
+        ticks = table[:, 0]
+        return MidiFileReader.ticks_to_seconds(ticks, division, tempos), table[:, 1], table[:, 2], table[:, 3]
+
+    @staticmethod
+    def ticks_to_seconds(ticks: np.ndarray, division: int, tempos: list) -> np.ndarray:
+        if division & 0x8000:
+            frames_per_second = 256 - (division >> 8)
+            return ticks / (frames_per_second * (division & 0xFF))
+
+        tempos = sorted(tempos)
+        if len(tempos) == 0 or tempos[0][0] != 0:
+            tempos.insert(0, (0, MidiFileReader.DEFAULT_TEMPO))
+        tempo_ticks = np.array([tick for tick, _ in tempos], dtype=np.int64)
+        seconds_per_tick = np.array([tempo for _, tempo in tempos], dtype=np.float64) / 1e6 / division
+        tempo_seconds = np.concatenate(([0], np.cumsum(np.diff(tempo_ticks) * seconds_per_tick[:-1])))
+        segment = np.searchsorted(tempo_ticks, ticks, side='right') - 1
+        return tempo_seconds[segment] + (ticks - tempo_ticks[segment]) * seconds_per_tick[segment]
+
+
+# Cue file: a 16 byte header (magic, version, record size, record count) followed by fixed-size records of
+# time in seconds, hue in degrees (-1 for no notes) and SetColor duration in milliseconds.
+class CueFile:
+    MAGIC: bytes = b'CNCU'
+    VERSION: int = 1
+    HEADER = struct.Struct('<4sHHQ')
+    RECORD = np.dtype([('time', '<f8'), ('hue', '<f4'), ('duration', '<u2'), ('reserved', '<u2')])
+
+    @staticmethod
+    def write(path: str, times: np.ndarray, hues: np.ndarray, durations: np.ndarray) -> None:
+        records = np.zeros(len(times), dtype=CueFile.RECORD)
+        records['time'] = times
+        records['hue'] = hues
+        records['duration'] = durations
+        with open(path, 'wb') as cue_file:
+            cue_file.write(CueFile.HEADER.pack(CueFile.MAGIC, CueFile.VERSION, CueFile.RECORD.itemsize, len(records)))
+            cue_file.write(records.tobytes())
+
+    @staticmethod
+    def read(path: str) -> np.ndarray:
+        with open(path, 'rb') as cue_file:
+            magic, version, record_size, count = CueFile.HEADER.unpack(cue_file.read(CueFile.HEADER.size))
+            if magic != CueFile.MAGIC or version != CueFile.VERSION or record_size != CueFile.RECORD.itemsize:
+                raise ValueError(f'{path} is not a version {CueFile.VERSION} cue file')
+            return np.fromfile(cue_file, dtype=CueFile.RECORD, count=count)
+
+
+# Renders a MIDI file to a cue file without playing it: the note and sustain semantics of NotesToHueConverter
+# are replayed into a velocity matrix, and hues are solved for all rows at once.
+class OfflineRenderer:
+    PITCH_COUNT: int = NotesToHueConverter.PITCH_COUNT
+    RANKS: int = 11  # most pitches of one pitch class that can be held at once
+    COLUMNS: int = RANKS * 12
+    CHUNK_ROWS: int = 16384  # rows solved at a time, bounds the (rows x candidates) temporaries
+    MAX_DURATION: int = 1000  # milliseconds
+
+    def __init__(self, channel: int | None = 0, wheel: dict = None):
+        self.channel: int | None = channel  # None renders every channel, MidiHandler only listens to the first
+        self.wheel: dict = MidiNote.note_to_hue if wheel is None else wheel
+
+    # One row per note, note off and sustain event: the velocity of every sounding pitch after that event, at
+    # column rank * 12 + pitch class, where rank orders the held pitches of a class by onset like the converter.
+    def velocity_matrix(
+            self,
+            statuses: np.ndarray,
+            data1: np.ndarray,
+            data2: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        kinds = statuses & 0xF0
+        selected = (kinds == 0x90) | (kinds == 0x80) | ((kinds == 0xB0) & (data1 == 64))
+        if self.channel is not None:
+            selected &= (statuses & 0x0F) == self.channel
+        rows = np.flatnonzero(selected)
+
+        state = bytearray(OfflineRenderer.PITCH_COUNT)
+        held = [[] for _ in range(12)]  # held pitches of each pitch class, in onset order
+        pedalled = set()
+        sustain = 0
+        row = bytearray(OfflineRenderer.COLUMNS)
+        matrix = bytearray()
+        for kind, pitch, value in zip(kinds[rows].tolist(), data1[rows].tolist(), data2[rows].tolist()):
+            if kind == 0x90 and value > 0:
+                if not state[pitch]:
+                    held[pitch % 12].append(pitch)
+                state[pitch] = value
+                pedalled.discard(pitch)
+                OfflineRenderer.write_ranks(row, held[pitch % 12], state, pitch % 12)
+            elif kind == 0xB0:
+                sustain = value
+                if sustain < NotesToHueConverter.SUSTAIN_THRESHOLD:
+                    for released in pedalled:
+                        state[released] = 0
+                        held[released % 12].remove(released)
+                        OfflineRenderer.write_ranks(row, held[released % 12], state, released % 12)
+                    pedalled.clear()
+            elif sustain < NotesToHueConverter.SUSTAIN_THRESHOLD:
+                if state[pitch]:
+                    state[pitch] = 0
+                    held[pitch % 12].remove(pitch)
+                    OfflineRenderer.write_ranks(row, held[pitch % 12], state, pitch % 12)
+            elif state[pitch]:
+                pedalled.add(pitch)
+            matrix += row
+        return np.frombuffer(bytes(matrix), dtype=np.uint8).reshape(-1, OfflineRenderer.COLUMNS), rows
+
+    @staticmethod
+    def write_ranks(row: bytearray, held: list[int], state: bytearray, pitch_class: int) -> None:
+        for rank in range(OfflineRenderer.RANKS):
+            row[rank * 12 + pitch_class] = state[held[rank]] if rank < len(held) else 0
+
+    # consecutive rows often hold the same notes, e.g. note offs under the sustain pedal, and are solved once
+    def solve_hues(self, matrix: np.ndarray) -> np.ndarray:
+        changed = np.ones(len(matrix), dtype=bool)
+        changed[1:] = np.any(matrix[1:] != matrix[:-1], axis=1)
+        return self.solve_hue_rows(matrix[changed])[np.cumsum(changed) - 1]
+
+    # NotesToHueConverter.solve_weighted_hues for every row at once. The solver unrolls the color wheel after the
+    # first k notes sorted by hue, then onset, so a candidate is a pitch class s (in hue order) with every class
+    # before it moved up by 360 degrees, plus the first j pitches of class s. Each of the 12 x 12 candidates is
+    # scored with the solver's exact integer distance, from prefix sums over the pitch classes laid out twice
+    # around the wheel. Rows where candidates with different hues tie are handed to the solver itself, so its
+    # tie-break applies.
+    def solve_hue_rows(self, matrix: np.ndarray) -> np.ndarray:
+        order = np.argsort([self.wheel[pitch_class] for pitch_class in range(12)], kind='stable')
+        wheel_hues = np.array([self.wheel[pitch_class] for pitch_class in order], dtype=np.int64)
+        unrolled = np.concatenate((wheel_hues, wheel_hues + 360))
+
+        hues = np.empty(len(matrix), dtype=np.float64)
+        for start in range(0, len(matrix), OfflineRenderer.CHUNK_ROWS):
+            chunk = matrix[start:start + OfflineRenderer.CHUNK_ROWS]
+            rows = len(chunk)
+            # rank x pitch class velocities, classes in hue order
+            ranks = chunk.astype(np.int64).reshape(rows, OfflineRenderer.RANKS, 12)[:, :, order]
+            velocities = ranks.sum(axis=1)[:, :, None]  # rows x s x 1
+            total = velocities.sum(axis=1)[:, :, None]  # rows x 1 x 1
+
+            # moved[:, s, j]: velocity of the first j pitches of class s
+            moved = np.zeros((rows, 12, 12), dtype=np.int64)
+            moved[:, :, 1:] = np.cumsum(ranks, axis=1).transpose(0, 2, 1)
+
+            zero = np.zeros((rows, 1), dtype=np.int64)
+            doubled = np.concatenate((velocities[:, :, 0], velocities[:, :, 0]), axis=1)
+            prefix_v = np.concatenate((zero, np.cumsum(doubled, axis=1)), axis=1)
+            prefix_vh = np.concatenate((zero, np.cumsum(doubled * unrolled, axis=1)), axis=1)
+            window_v = prefix_v[:, :12, None]
+            window_vh = prefix_vh[:, :12, None]
+            numerators = prefix_vh[:, 12:24, None] - window_vh + 360 * moved
+
+            # the window s..s + 12 counts the split class at both ends, with all of its velocity at each
+            split = np.searchsorted(unrolled, numerators // np.maximum(total, 1), side='right')
+            split = np.clip(split, np.arange(12)[:, None], np.arange(13, 25)[:, None]).reshape(rows, 144)
+            below_v = np.take_along_axis(prefix_v, split, axis=1).reshape(rows, 12, 12)
+            below_vh = np.take_along_axis(prefix_vh, split, axis=1).reshape(rows, 12, 12)
+            above_v = prefix_v[:, 13:25, None] - below_v
+            above_vh = prefix_vh[:, 13:25, None] - below_vh
+            below_v -= window_v
+            below_vh -= window_vh
+            distances = numerators * (below_v - above_v) + total * (above_vh - below_vh)
+            distances -= moved * np.abs(numerators - total * wheel_hues[:, None])
+            distances -= (velocities - moved) * np.abs(numerators - total * (wheel_hues[:, None] + 360))
+
+            total = total.reshape(rows, 1)
+            distances = distances.reshape(rows, 144)
+            numerators = numerators.reshape(rows, 144)
+            best = distances.argmin(axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                chunk_hues = (numerators[np.arange(rows), best] / total[:, 0]) % 360
+
+            # candidates a whole turn apart are the same hue
+            tied = distances == distances[np.arange(rows), best][:, None]
+            turns = numerators % np.maximum(360 * total, 1)
+            ambiguous = np.flatnonzero(
+                (np.where(tied, turns, -1).max(axis=1) != np.where(tied, turns, turns.max() + 1).min(axis=1))
+                & (total[:, 0] > 0)
+            )
+            for row in ambiguous.tolist():
+                columns = np.flatnonzero(chunk[row])  # each class in onset order, as the converter passes them
+                chunk_hues[row] = NotesToHueConverter.solve_weighted_hues(
+                    [self.wheel[column % 12] for column in columns.tolist()],
+                    chunk[row, columns].tolist()
+                )
+            chunk_hues[total[:, 0] == 0] = -1
+            hues[start:start + rows] = chunk_hues
+        return hues
+
+    # Keeps the first event and the events that change the hue, like the converter publishing only changes, and
+    # the last of several changes at the same time. Each cue fades until the next one, the last one for
+    # MAX_DURATION. The first cue is kept whatever its hue, since a looped or restarted show starts on it.
+    def render(self, path: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        seconds, statuses, data1, data2 = MidiFileReader.read(path)
+        matrix, rows = self.velocity_matrix(statuses, data1, data2)
+        hues = self.solve_hues(matrix)
+        times = seconds[rows]
+
+        if len(times) == 0:
+            return times, hues, np.zeros(0, dtype=np.uint16)
+        changed = np.concatenate(([True], hues[1:] != hues[:-1]))
+        times, hues = times[changed], hues[changed]
+        last_at_time = np.concatenate((times[1:] != times[:-1], [True]))
+        times, hues = times[last_at_time], hues[last_at_time]
+
+        durations = np.diff(times, append=times[-1:] + OfflineRenderer.MAX_DURATION / 1000) * 1000
+        durations = np.minimum(durations, OfflineRenderer.MAX_DURATION).astype(np.uint16)
+        return times, hues, durations
+
+    def render_to_cue_file(self, path: str, cue_path: str) -> int:
+        times, hues, durations = self.render(path)
+        CueFile.write(cue_path, times, hues, durations)
+        return len(times)
+
+
+if __name__ == "__main__":
+    arguments = sys.argv[1:]
+    midi_channel = 0
+    if '--channel' in arguments:
+        index = arguments.index('--channel')
+        value = arguments[index + 1] if index + 1 < len(arguments) else ''
+        midi_channel = None if value == 'all' else int(value) - 1 if value.isdigit() else -1
+        del arguments[index:index + 2]
+    if len(arguments) < 1 or not (midi_channel is None or 0 <= midi_channel < 16):
+        print('Usage: python offline_renderer.py <file.mid> [file.cue] [--channel 1-16|all]')
+        sys.exit(1)
+    midi_path = arguments[0]
+    cue_path = arguments[1] if len(arguments) > 1 else midi_path.rsplit('.', 1)[0] + '.cue'
+    start_time = time.perf_counter()
+    cue_count = OfflineRenderer(midi_channel).render_to_cue_file(midi_path, cue_path)
+    print(f'Rendered {cue_count} cues to {cue_path} in {time.perf_counter() - start_time:.2f} seconds.')
@@ -0,0 +1,35 @@
+import time
+
+
+# Running estimate of the time between note onsets, used to size bulb-side fades: the bulb keeps interpolating
+# until the next change is expected, so slow passages fade smoothly with few packets and fast ones stay crisp.
+class OnsetEstimator:
+    CHORD_WINDOW: float = 0.03  # seconds, onsets closer than this belong to the same chord
+    MAX_INTERVAL: float = 2  # seconds, longer pauses count as this much
+    SMOOTHING: float = 0.3  # weight of the newest interval in the moving average
+    MIN_DURATION: int = 20  # milliseconds
+    MAX_DURATION: int = 1000  # milliseconds
+    DEFAULT_DURATION: int = 100  # milliseconds, until two onsets have been seen
+
+    def __init__(self):
+        self.last_onset: float | None = None
+        self.interval: float | None = None  # seconds
+
+    def add_onset(self, timestamp: float = None) -> None:
+        timestamp = time.monotonic() if timestamp is None else timestamp
+        if self.last_onset is not None:
+            gap = timestamp - self.last_onset
+            if gap < OnsetEstimator.CHORD_WINDOW:
+                return
+            gap = min(gap, OnsetEstimator.MAX_INTERVAL)
+            if self.interval is None:
+                self.interval = gap
+            else:
+                self.interval += OnsetEstimator.SMOOTHING * (gap - self.interval)
+        self.last_onset = timestamp
+
+    @property
+    def transition_duration(self) -> int:
+        if self.interval is None:
+            return OnsetEstimator.DEFAULT_DURATION
+        return max(OnsetEstimator.MIN_DURATION, min(OnsetEstimator.MAX_DURATION, int(self.interval * 1000)))
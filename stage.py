@@ -0,0 +1,124 @@
+import asyncio
+import json
+import sys
+from typing import NamedTuple
+
+from frame_scheduler import FrameScheduler
+from globals import Globals
+from lifx_device import LifxDevice
+from lifx_device_set import LifxDeviceSet
+from midi_handler import MidiHandler
+from notes_to_hue_converter import NotesToHueConverter
+
+
+class StageGroup(NamedTuple):
+    name: str
+    midi_input_index: int = 0
+    channel: int | None = None  # MIDI channel 0-15, None for every channel not claimed by another group of the port
+    labels: tuple[str, ...] | None = None  # bulbs driven by this group, None for every bulb not claimed by another
+
+
+# Several instruments on one stage: each group has its own converter fed by one port and channel, and its own
+# device set and frame scheduler. Every port has its own handler and every converter its own queue, so a dense
+# part never delays another group. A bulb belongs to at most one group.
+class Stage:
+    def __init__(self, groups: list[StageGroup], devices: list[LifxDevice], tick_rate: float = 30):
+        self.groups: list[StageGroup] = groups
+        self.converters: dict[str, NotesToHueConverter] = {group.name: NotesToHueConverter() for group in groups}
+        self.device_sets: dict[str, LifxDeviceSet] = {
+            group.name: LifxDeviceSet(self.converters[group.name]) for group in groups
+        }
+        self.assign_devices(devices)
+        self.schedulers: dict[str, FrameScheduler] = {
+            name: FrameScheduler(device_set, tick_rate) for name, device_set in self.device_sets.items()
+        }
+        self.handlers: dict[int, MidiHandler] = {}
+        for group in groups:
+            handler = self.handlers.setdefault(group.midi_input_index, MidiHandler(group.midi_input_index, {}))
+            if group.channel in handler.routes:
+                raise ValueError(f'Port {group.midi_input_index} channel {group.channel} is routed to two groups')
+            handler.routes[group.channel] = self.converters[group.name]
+
+    # groups naming their bulbs pick first, a group without labels takes every bulb left over
+    def assign_devices(self, devices: list[LifxDevice]) -> None:
+        unclaimed = list(devices)
+        for group in sorted(self.groups, key=lambda group: group.labels is None):
+            if group.labels is None:
+                claimed = unclaimed
+            else:
+                claimed = [device for device in unclaimed if device.state.get('label') in group.labels]
+            self.device_sets[group.name].devices = claimed
+            unclaimed = [device for device in unclaimed if device not in claimed]
+
+    def record_routes(self) -> None:
+        for group in self.groups:
+            addresses = [device.address for device in self.device_sets[group.name].devices]
+            Globals.journal.record_route(group.midi_input_index, group.channel, addresses)
+
+    async def is_midi_input_working(self) -> bool:
+        for handler in self.handlers.values():
+            if not await handler.is_midi_input_working():
+                return False
+        return True
+
+    async def start(self, streaming: bool = True) -> None:
+        await asyncio.gather(
+            *[handler.start_receiving() for handler in self.handlers.values()],
+            *[scheduler.start(streaming) for scheduler in self.schedulers.values()]
+        )
+
+    async def stop(self) -> None:
+        for handler in self.handlers.values():
+            await handler.stop_receiving()
+        for scheduler in self.schedulers.values():
+            scheduler.stop()
+
+    @property
+    def stats(self) -> dict:
+        return {
+            group.name: {
+                'devices': len(self.device_sets[group.name].devices),
+                **self.schedulers[group.name].stats
+            }
+            for group in self.groups
+        }
+
+    # a JSON list of groups, e.g. [{"name": "keys", "midi_input_index": 0, "labels": ["Left", "Right"]}]
+    @staticmethod
+    def load_groups(path: str) -> list[StageGroup]:
+        with open(path) as groups_file:
+            entries = json.load(groups_file)
+        return [
+            StageGroup(**{**entry, 'labels': None if entry.get('labels') is None else tuple(entry['labels'])})
+            for entry in entries
+        ]
+
+
+async def main(groups_path: str, seconds: float = 30) -> None:
+    devices = LifxDeviceSet.load_cached_devices()
+    if len(devices) == 0:
+        devices = await LifxDeviceSet().discover_devices(0.5)
+    stage = Stage(Stage.load_groups(groups_path), devices)
+    if not await stage.is_midi_input_working():
+        return
+
+    Globals.journal.open('journal.bin')
+    stage.record_routes()
+    await Globals.router.set_receiving(True)
+    asyncio.create_task(Globals.router.start_receiving())
+    asyncio.create_task(stage.start(streaming=True))
+
+    await asyncio.sleep(seconds)
+    await stage.stop()
+
+    print('Shutting down...')
+    await asyncio.create_task(Globals.router.set_receiving(False))
+    Globals.journal.close()
+    print(stage.stats)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print('Usage: python stage.py <groups.json> [seconds]')
+        sys.exit(1)
+    asyncio.run(main(sys.argv[1], float(sys.argv[2]) if len(sys.argv) > 2 else 30))
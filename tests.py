@@ -1,7 +1,20 @@
+import os
 import time
+import random
 import asyncio
+import tempfile
+import numpy as np
+from controller_state import ControllerState
+from cue_player import CuePlayer
 from globals import Globals
+from lifx_device import LifxDevice
 from lifx_device_set import LifxDeviceSet
+from lifx_emulator import LifxEmulatorFleet
+from message_encoder import convert_mac_to_int
+from message_maker import MessageMaker
+from message_router import ResponseTimeout
+from notes_to_hue_converter import MidiNote, NotesToHueConverter, PitchClassHueTable
+from offline_renderer import CueFile, OfflineRenderer
 
 
 class Tests:
@@ -53,8 +66,281 @@ class Tests:
         print((time.time() - start_time) / 360)
         return {'result': True},
 
+    # the generic encoder, with the header fields a packet template fixes
+    @staticmethod
+    def encoded_set_color(color: dict, sequence: int, target: str = None, ack_required: bool = True) -> bytes:
+        encoder = MessageMaker.SetColor(**color)
+        encoder.tagged = 1 if target is None else 0
+        encoder.target_addr = '00:00:00:00:00:00' if target is None else target
+        encoder.ack_required = 1 if ack_required else 0
+        encoder.sequence = sequence
+        return bytes(encoder.generate_packed_message())
+
+    # the SetColor fast path, through enough packets for the sequence number to wrap around
+    @staticmethod
+    async def test_set_color_packet_matches_encoder(iterations: int = 600) -> tuple:
+        target = 'd0:73:d5:01:02:03'
+        packets = [
+            (MessageMaker.SetColorPacket(), None, False),
+            (MessageMaker.SetColorPacket(ack_required=True), None, True),
+            (MessageMaker.SetColorPacket(tagged=False), target, False),
+            (MessageMaker.SetColorPacket(ack_required=True, tagged=False), target, True)
+        ]
+        wrapped = False
+        last_sequence = -1
+        for i in range(iterations):
+            color = {
+                'hue': random.uniform(-360, 720),
+                'saturation': random.random(),
+                'brightness': random.random(),
+                'kelvin': random.randint(1500, 9000),
+                'duration': random.randint(0, 65535)
+            }
+            packet, packet_target, ack_required = packets[i % len(packets)]
+            target_int = 0 if packet_target is None else convert_mac_to_int(packet_target)
+            packed = bytes(packet.pack(**color, target=target_int))
+            wrapped |= packet.sequence < last_sequence
+            last_sequence = packet.sequence
+            if packed != Tests.encoded_set_color(color, packet.sequence, packet_target, ack_required):
+                return {'result': False, 'color': color, 'target': packet_target},
+        return {'result': wrapped},
+
+    # the cue player writes hue, saturation, brightness, kelvin, duration and sequence at fixed offsets
+    @staticmethod
+    async def test_cue_player_packets_match_encoder(cue_count: int = 300) -> tuple:
+        devices = [LifxDevice(('127.0.0.1', 56700)), LifxDevice(('127.0.0.2', 56700), target='d073d5010203')]
+        cues = np.zeros(cue_count, dtype=CueFile.RECORD)
+        cues['time'] = np.arange(cue_count) / 10
+        cues['hue'] = [random.choice([-1, random.uniform(0, 360)]) for _ in range(cue_count)]
+        cues['duration'] = [random.randint(0, 1000) for _ in range(cue_count)]
+        player = CuePlayer(devices, cues)
+        for cue in range(cue_count):
+            hue = float(cues['hue'][cue])
+            color = LifxDeviceSet.color_for_hue(hue)
+            color = {'hue': 0, **color, 'duration': int(cues['duration'][cue])}
+            for column, target in enumerate([None, 'd0:73:d5:01:02:03']):
+                expected = Tests.encoded_set_color(color, cue % 256, target, ack_required=False)
+                if bytes(player.packet(cue, column)) != expected:
+                    return {'result': False, 'cue': cue, 'column': column},
+        return {'result': True},
+
+    # the original search: rotate each note by 360 in turn and recompute everything
+    @staticmethod
+    def reference_hue(notes: list[MidiNote]) -> float:
+        if len(notes) == 0:
+            return -1
+        hues = sorted([[note.hue, note.velocity] for note in notes], key=lambda n: n[0])
+        weighted_average = lambda: sum([h * v for h, v in hues]) / sum([v for _, v in hues])
+        distance_from_hue = lambda hue: sum([abs(v * (hue - h)) for h, v in hues])
+        best_hue = weighted_average()
+        best_distance = distance_from_hue(best_hue)
+        for note in hues:
+            note[0] += 360
+            new_hue = weighted_average()
+            new_distance = distance_from_hue(new_hue)
+            if new_distance < best_distance:
+                best_hue = new_hue
+                best_distance = new_distance
+        return best_hue % 360
+
+    @staticmethod
+    async def test_solve_hue_matches_reference(iterations: int = 10000) -> tuple:
+        for _ in range(iterations):
+            pitches = random.sample(range(128), random.randint(1, 88))
+            notes = [MidiNote(pitch=pitch, velocity=random.randint(1, 127)) for pitch in pitches]
+            if NotesToHueConverter.solve_hue(notes) != Tests.reference_hue(notes):
+                return {'result': False, 'notes': [str(note) for note in notes]},
+        return {'result': True},
+
+    # table mode solves the held pitch classes weighted by their summed velocities, within 1e-9 degrees of the solver
+    @staticmethod
+    async def test_table_hue_matches_solver(iterations: int = 10000, bound: float = 1e-9) -> tuple:
+        table = PitchClassHueTable()
+        for _ in range(iterations):
+            mask = random.randrange(1, PitchClassHueTable.SIZE)
+            pitch_classes = [pitch_class for pitch_class in range(12) if (mask >> pitch_class) & 1]
+            class_velocities = [0] * 12
+            for pitch_class in pitch_classes:
+                class_velocities[pitch_class] = sum(random.randint(1, 127) for _ in range(random.randint(1, 3)))
+            expected = NotesToHueConverter.solve_weighted_hues(
+                [MidiNote.note_to_hue[pitch_class] for pitch_class in pitch_classes],
+                [class_velocities[pitch_class] for pitch_class in pitch_classes]
+            )
+            hue = table.correct_for_velocities(mask, class_velocities)
+            if abs((hue - expected + 180) % 360 - 180) > bound:
+                return {'result': False, 'pitch_classes': pitch_classes, 'velocities': class_velocities},
+        return {'result': True},
+
+    # a burst of controller messages between two frames reaches the next frame as its last value only
+    @staticmethod
+    async def test_controller_state_coalesces() -> tuple:
+        controllers = ControllerState()
+        controllers.set('velocity', 0)
+        burst = [random.randint(0, ControllerState.MAX_VALUE) for _ in range(500)] + [ControllerState.MAX_VALUE]
+        for value in burst:
+            controllers.set('aftertouch', value)
+        for value in burst[:-1]:
+            controllers.set_cc(1, value)
+        controllers.set_cc(1, 0)
+        controllers.set_pitch_bend(127, 127)
+        was_pending = controllers.is_pending
+        color = controllers.modulate({'hue': 120, 'kelvin': ControllerState.MAX_KELVIN})
+        changes = controllers.version
+        controllers.set('aftertouch', ControllerState.MAX_VALUE)
+        controllers.set_pitch_bend(0, 0)
+        low = controllers.modulate({'hue': 120, 'kelvin': ControllerState.MIN_KELVIN})
+        return {
+            'result': was_pending and not controllers.is_pending and color['brightness'] == 1
+            and color['saturation'] == 1 and color['kelvin'] == ControllerState.MAX_KELVIN
+            and low['kelvin'] == ControllerState.MIN_KELVIN and controllers.read_version == controllers.version
+            and controllers.received == 2 * len(burst) + 4 and controllers.coalesced == changes - 1,
+            'received': controllers.received,
+            'coalesced': controllers.coalesced
+        },
+
+    # the original converter's note list: notes in the order they were added, a note struck again keeps its place
+    @staticmethod
+    def reference_converter_hues(events: list[tuple]) -> list[float]:
+        notes = []
+        sustain = 0
+        hues = []
+        for kind, pitch, value in events:
+            held = [note for note in notes if note.pitch == pitch]
+            if kind == 'on':
+                if held:
+                    held[0].velocity = value
+                    held[0].is_pedalled = False
+                else:
+                    notes.append(MidiNote(pitch=pitch, velocity=value))
+            elif kind == 'off' and held:
+                if sustain < NotesToHueConverter.SUSTAIN_THRESHOLD:
+                    notes.remove(held[0])
+                else:
+                    held[0].is_pedalled = True
+            elif kind == 'sustain':
+                sustain = value
+                if sustain < NotesToHueConverter.SUSTAIN_THRESHOLD:
+                    notes = [note for note in notes if not note.is_pedalled]
+            hues.append(Tests.reference_hue(notes))
+        return hues
+
+    # a narrow pitch range, so that pitches of the same class are often held together
+    @staticmethod
+    def random_events(event_count: int) -> list[tuple]:
+        events = []
+        for _ in range(event_count):
+            kind = random.choice(['on', 'on', 'off', 'sustain'])
+            value = random.choice([0, 127]) if kind == 'sustain' else random.randint(1, 127)
+            events.append((kind, random.randint(36, 84), value))
+        return events
+
+    @staticmethod
+    async def apply_event(converter: NotesToHueConverter, event: tuple) -> float:
+        kind, pitch, value = event
+        if kind == 'on':
+            await converter.add_note(MidiNote(pitch=pitch, velocity=value))
+        elif kind == 'off':
+            await converter.remove_note(pitch)
+        else:
+            await converter.set_sustain(value)
+        return await converter.convert()
+
+    @staticmethod
+    async def test_converter_matches_reference(iterations: int = 200, event_count: int = 200) -> tuple:
+        cases = [[('on', 80, 127), ('on', 62, 20), ('on', 51, 127), ('on', 50, 60)]]
+        cases += [Tests.random_events(event_count) for _ in range(iterations)]
+        for events in cases:
+            converter = NotesToHueConverter()
+            for event, expected in zip(events, Tests.reference_converter_hues(events)):
+                if await Tests.apply_event(converter, event) != expected:
+                    return {'result': False, 'events': events},
+        return {'result': True},
+
+    @staticmethod
+    async def test_offline_renderer_matches_converter(iterations: int = 50, event_count: int = 200) -> tuple:
+        renderer = OfflineRenderer()
+        statuses = {'on': 0x90, 'off': 0x80, 'sustain': 0xB0}
+        for _ in range(iterations):
+            events = Tests.random_events(event_count)
+            matrix, _ = renderer.velocity_matrix(
+                np.array([statuses[kind] for kind, _, _ in events]),
+                np.array([64 if kind == 'sustain' else pitch for kind, pitch, _ in events]),
+                np.array([value for _, _, value in events])
+            )
+            converter = NotesToHueConverter()
+            for event, hue in zip(events, renderer.solve_hues(matrix).tolist()):
+                expected = await Tests.apply_event(converter, event)
+                if abs((hue - expected + 180) % 360 - 180) > 1e-9:
+                    return {'result': False, 'events': events},
+        return {'result': True},
+
+    # a format 0 Standard MIDI File, 96 ticks per quarter note, of (delta ticks, message bytes) events
+    @staticmethod
+    def write_midi_file(path: str, events: list[tuple]) -> None:
+        track = b''
+        for delta, message in events:
+            track += bytes([delta]) + bytes(message)  # deltas below 128 are a single variable length byte
+        track += b'\x00\xff\x2f\x00'
+        with open(path, 'wb') as midi_file:
+            midi_file.write(b'MThd' + (6).to_bytes(4, 'big') + (0).to_bytes(2, 'big') + (1).to_bytes(2, 'big'))
+            midi_file.write((96).to_bytes(2, 'big') + b'MTrk' + len(track).to_bytes(4, 'big') + track)
+
+    @staticmethod
+    async def test_offline_renderer_files() -> tuple:
+        files = {
+            'empty': [],
+            'off_channel': [(0, [0x91, 64, 100]), (48, [0x81, 64, 0])],
+            'starts_on_hue_0': [(0, [0x90, 60, 100]), (48, [0x90, 67, 100]), (48, [0x80, 60, 0]), (48, [0x80, 67, 0])]
+        }
+        rendered = {}
+        with tempfile.TemporaryDirectory() as directory:
+            for name, events in files.items():
+                path = os.path.join(directory, name + '.mid')
+                Tests.write_midi_file(path, events)
+                rendered[name] = OfflineRenderer().render(path)
+            rendered['all_channels'] = OfflineRenderer(channel=None).render(os.path.join(directory, 'off_channel.mid'))
+        return {
+            'result': len(rendered['empty'][0]) == 0
+            and len(rendered['off_channel'][0]) == 0
+            and rendered['all_channels'][1].tolist() == [120, -1]
+            and rendered['starts_on_hue_0'][1].tolist() == [0, 15, 30, -1],
+            'cues': {name: hues.tolist() for name, (_, hues, _) in rendered.items()}
+        },
+
+    @staticmethod
+    async def test_emulated_fleet_throughput(device_count: int = 200, rounds: int = 20, **fleet_options) -> tuple:
+        fleet = LifxEmulatorFleet(device_count, **fleet_options)
+        try:
+            device_set = LifxDeviceSet()
+            device_set.devices = [LifxDevice(address) for address in await fleet.start()]
+            labels = await device_set.all_devices_get('label', return_exceptions=True)
+            timeouts = 0
+            start_time = time.time()
+            for i in range(rounds):
+                results = await device_set.all_devices_do('set_color', {'hue': 180 * (i % 2)}, return_exceptions=True)
+                timeouts += sum(1 for result in results if isinstance(result, ResponseTimeout))
+            elapsed = time.time() - start_time
+        finally:
+            fleet.close()
+            await asyncio.sleep(0)  # transports release their ports on the next loop iteration
+        return {
+            'result': sum(not isinstance(label, Exception) for label in labels) == device_count,
+            'acks_per_sec': (device_count * rounds - timeouts) / elapsed,
+            'timeouts': timeouts,
+            **fleet.stats
+        },
+
 
 async def run_tests():
+    print(await Tests.test_set_color_packet_matches_encoder())
+    print(await Tests.test_cue_player_packets_match_encoder())
+    print(await Tests.test_solve_hue_matches_reference())
+    print(await Tests.test_table_hue_matches_solver())
+    print(await Tests.test_controller_state_coalesces())
+    print(await Tests.test_converter_matches_reference())
+    print(await Tests.test_offline_renderer_matches_converter())
+    print(await Tests.test_offline_renderer_files())
+    print(await Tests.test_emulated_fleet_throughput())
     print(await Tests.test_get_all_labels())
     # await Tests.test_turn_on()
     # await Tests.test_turn_off()